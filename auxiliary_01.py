@@ -17,24 +17,344 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import os
+import shutil
+import time
+from contextlib import contextmanager
 import pandas as pd
+from auxiliary_08 import *
 
 PROJECTS_DIR = 'projects'
 projects = [name for name in os.listdir(PROJECTS_DIR) if os.path.isdir(os.path.join(PROJECTS_DIR, name))]
 
+# Format of the project working files (all_data, inclusions, exclusions, duplicates): csv, parquet or arrow
+STORAGE_FORMAT = os.environ.get('STORAGE_FORMAT', 'csv')
+STORAGE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+WORKING_TABLES = ['all_data', 'inclusions', 'exclusions', 'duplicates']
+# Identifiers that look like numbers yet are read as text, so e.g. arXiv ID 2101.00010 keeps its last digit
+TEXT_FIELDS = {'arXiv ID': str}
+
+
+# The project a working file belongs to, used to label its I/O measurements
+def path_project(file_path):
+    parts = os.path.relpath(file_path, PROJECTS_DIR).split(os.sep)
+    return parts[0] if len(parts) > 1 and parts[0] != os.pardir else None
+
 
 def read_csv(file_path):
-    return pd.read_csv(file_path) if os.path.exists(file_path) else pd.DataFrame()
+    if not os.path.exists(file_path):
+        return pd.DataFrame()
+    with instrument('csv_read', path_project(file_path)) as measurement:
+        try:
+            df = pd.read_csv(file_path, dtype=TEXT_FIELDS)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame()
+        measurement['rows'] = len(df)
+    return df
+
+
+def read_csv_header(file_path):
+    try:
+        return list(pd.read_csv(file_path, nrows=0).columns) if os.path.exists(file_path) else []
+    except pd.errors.EmptyDataError:
+        return []
+
+
+# Reads a CSV in chunks of at most chunk_rows rows so large exports never have to fit in memory at once
+def read_csv_chunks(file_path, chunk_rows, dtype=None):
+    header = read_csv_header(file_path)
+    if not header:
+        return
+    if isinstance(dtype, dict):
+        dtype = {column: kind for column, kind in dtype.items() if column in header}
+    chunks = pd.read_csv(file_path, chunksize=chunk_rows, dtype=dtype)
+    while True:
+        with instrument('csv_read', path_project(file_path)) as measurement:
+            chunk = next(chunks, None)
+            measurement['rows'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            return
+        yield chunk
 
 
 def get_project_path(project_name, filename):
     return os.path.join(PROJECTS_DIR, project_name, filename)
 
 
+# Serialises work on a project's files across processes, e.g. ingestion and exports from several app workers
+@contextmanager
+def project_lock(project_name):
+    with open(get_project_path(project_name, '.lock'), 'a+') as file:
+        if os.name == 'nt':
+            import msvcrt
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
 def save_csv(df, file_path):
-    print(f"1 - Saving {file_path}")
-    df.to_csv(file_path, index=False)
+    logging.info(f"1 - Saving {file_path}")
+    with instrument('csv_write', path_project(file_path), len(df)):
+        tmp_path = f"{file_path}.tmp"
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, file_path)
+
+
+# Appends rows without rewriting the file, unless df brings columns the file does not have yet
+def append_csv(df, file_path):
+    columns = read_csv_header(file_path)
+
+    if columns and set(df.columns) <= set(columns):
+        logging.info(f"1 - Appending {len(df)} records to {file_path}")
+        with instrument('csv_append', path_project(file_path), len(df)):
+            df.reindex(columns=columns).to_csv(file_path, mode='a', header=False, index=False)
+    else:
+        save_csv(pd.concat([read_csv(file_path), df], ignore_index=True), file_path)
+
+
+def get_table_path(project_name, name):
+    return get_project_path(project_name, name + STORAGE_EXTENSIONS[STORAGE_FORMAT])
+
+
+def _csv_path(file_path):
+    return os.path.splitext(file_path)[0] + '.csv'
+
+
+# A working file that only exists as CSV yet is read from the CSV and converted on its next save
+def _resolve_table(file_path):
+    if not file_path.endswith('.csv') and not os.path.exists(file_path):
+        return _csv_path(file_path)
+    return file_path
+
+
+def table_exists(file_path):
+    return os.path.exists(_resolve_table(file_path))
+
+
+# Changes whenever the file is rewritten or appended to
+def table_signature(file_path):
+    file_path = _resolve_table(file_path)
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _arrow_table(df):
+    import pyarrow as pa
+
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if not values.map(lambda value: isinstance(value, str)).all():
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def read_table(file_path, columns=None):
+    file_path = _resolve_table(file_path)
+    if not os.path.exists(file_path):
+        return pd.DataFrame()
+
+    if file_path.endswith('.csv') and columns is None:
+        return read_csv(file_path)
+
+    with instrument(os.path.splitext(file_path)[1][1:] + '_read', path_project(file_path)) as measurement:
+        df = _read_table(file_path, columns)
+        measurement['rows'] = len(df)
+    return df
+
+
+def _read_table(file_path, columns):
+    if file_path.endswith('.csv'):
+        available = set(read_csv_header(file_path))
+        return pd.read_csv(file_path, usecols=lambda column: column in columns, dtype=TEXT_FIELDS)[[c for c in columns if c in available]]
+
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        schema_columns = pq.read_schema(file_path).names
+        selected = None if columns is None else [c for c in columns if c in schema_columns]
+        return pq.read_table(file_path, columns=selected, memory_map=True).to_pandas()
+
+    import pyarrow.feather as feather
+    table = feather.read_table(file_path, memory_map=True)
+    if columns is not None:
+        table = table.select([c for c in columns if c in table.column_names])
+    return table.to_pandas()
+
+
+def count_rows(file_path):
+    file_path = _resolve_table(file_path)
+    if not os.path.exists(file_path):
+        return 0
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(file_path).metadata.num_rows
+    if file_path.endswith('.arrow'):
+        import pyarrow.feather as feather
+        return feather.read_table(file_path, memory_map=True).num_rows
+    return len(read_csv(file_path))
+
+
+def save_table(df, file_path):
+    if file_path.endswith('.csv'):
+        save_csv(df, file_path)
+        return
+
+    logging.info(f"1 - Saving {file_path}")
+    with instrument(os.path.splitext(file_path)[1][1:] + '_write', path_project(file_path), len(df)):
+        tmp_path = f"{file_path}.tmp"
+        table = _arrow_table(df)
+        if file_path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp_path)
+        else:
+            import pyarrow.feather as feather
+            # Uncompressed so reads can be memory-mapped without a copy
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, file_path)
+
+
+def _parts_dir(file_path):
+    return f"{file_path}.parts"
+
+
+# Parquet and arrow files cannot be appended to, so each appended chunk is written to a part file next to the
+# table, and compact_table merges them in once at the end of the run
+def append_table(df, file_path):
+    if file_path.endswith('.csv'):
+        append_csv(df, file_path)
+        return
+    parts_dir = _parts_dir(file_path)
+    os.makedirs(parts_dir, exist_ok=True)
+    save_table(df, os.path.join(parts_dir, f"{len(os.listdir(parts_dir)):06d}{os.path.splitext(file_path)[1]}"))
+
+
+# How far a file has been appended to: the size and columns of a CSV, or the number of parts of any other file
+def append_checkpoint(file_path):
+    if file_path.endswith('.csv'):
+        return {'size': os.path.getsize(file_path), 'columns': read_csv_header(file_path)} \
+            if os.path.exists(file_path) else None
+    parts_dir = _parts_dir(file_path)
+    return len([name for name in os.listdir(parts_dir) if not name.endswith('.tmp')]) if os.path.isdir(parts_dir) else 0
+
+
+# Drops whatever was appended to a file after checkpoint, e.g. by a run that crashed halfway through a chunk.
+# A CSV that gained columns was rewritten whole, so the appended_rows it ends with are dropped instead.
+def rollback_appends(file_path, checkpoint, appended_rows=0):
+    if file_path.endswith('.csv'):
+        if not os.path.exists(file_path):
+            return
+        if checkpoint is None:
+            os.remove(file_path)
+        elif read_csv_header(file_path) == checkpoint['columns']:
+            if os.path.getsize(file_path) > checkpoint['size']:
+                with open(file_path, 'r+b') as file:
+                    file.truncate(checkpoint['size'])
+        elif appended_rows:
+            df = read_csv(file_path)
+            save_csv(df.iloc[:len(df) - appended_rows], file_path)
+        return
+    parts_dir = _parts_dir(file_path)
+    if os.path.isdir(parts_dir):
+        names = sorted(os.listdir(parts_dir))
+        parts = [name for name in names if not name.endswith('.tmp')]
+        for name in parts[checkpoint:] + [name for name in names if name.endswith('.tmp')]:
+            os.remove(os.path.join(parts_dir, name))
+
+
+def _pandas_metadata(schemas):
+    metadata = [json.loads(schema.metadata[b'pandas']) for schema in schemas
+                if schema.metadata and b'pandas' in schema.metadata]
+    if not metadata:
+        return {}
+    columns = {}
+    for entry in metadata:
+        for column in entry['columns']:
+            columns.setdefault(column['name'], column)
+    return {b'pandas': json.dumps(dict(metadata[0], columns=list(columns.values()))).encode('utf-8')}
+
+
+def _conform(table, schema):
+    import pyarrow as pa
+    return pa.Table.from_arrays([table.column(field.name).cast(field.type) if field.name in table.column_names
+                                 else pa.nulls(len(table), field.type) for field in schema], schema=schema)
+
+
+# Merges the part files appended since the last compaction into the table, reading each piece once.
+# Parquet is streamed batch by batch; an arrow file needs one dictionary per column, so its pieces are
+# memory-mapped and written together.
+def compact_table(file_path):
+    parts_dir = _parts_dir(file_path)
+    if file_path.endswith('.csv') or not os.path.isdir(parts_dir):
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    extension = os.path.splitext(file_path)[1]
+    # Parts cut short by a crash are still .tmp files and are dropped along with the directory
+    parts = [os.path.join(parts_dir, name) for name in sorted(os.listdir(parts_dir)) if name.endswith(extension)]
+    if not parts:
+        shutil.rmtree(parts_dir)
+        return
+    with instrument(extension[1:] + '_compact', path_project(file_path)) as measurement:
+        existing = _resolve_table(file_path)
+        tables = []
+        if os.path.exists(existing) and existing.endswith('.csv'):
+            tables.append(_arrow_table(read_csv(existing)))
+        elif os.path.exists(existing):
+            tables.append(pq.ParquetFile(existing) if extension == '.parquet'
+                          else pa.ipc.open_file(pa.memory_map(existing)).read_all())
+        for part in parts:
+            tables.append(pq.ParquetFile(part) if extension == '.parquet'
+                          else pa.ipc.open_file(pa.memory_map(part)).read_all())
+
+        schemas = [table.schema_arrow if isinstance(table, pq.ParquetFile) else table.schema for table in tables]
+        schema = pa.unify_schemas(schemas, promote_options='permissive').with_metadata(_pandas_metadata(schemas))
+        tmp_path = f"{file_path}.tmp"
+        rows = 0
+        if extension == '.parquet':
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for table in tables:
+                    batches = table.iter_batches() if isinstance(table, pq.ParquetFile) else table.to_batches()
+                    for batch in batches:
+                        writer.write_table(_conform(pa.Table.from_batches([batch]), schema))
+                        rows += batch.num_rows
+        else:
+            merged = pa.concat_tables([_conform(table, schema) for table in tables]).unify_dictionaries()
+            with pa.ipc.new_file(tmp_path, schema) as writer:
+                writer.write_table(merged)
+            rows = merged.num_rows
+        # Mapped and open files are let go first, so the table can be replaced on Windows too
+        tables.clear()
+        table = merged = None
+        os.replace(tmp_path, file_path)
+        shutil.rmtree(parts_dir)
+        measurement['rows'] = rows
+
+
+# Writes the working files of a project as CSV, for use in other tools
+def export_tables_to_csv(project_name):
+    for name in WORKING_TABLES:
+        file_path = get_table_path(project_name, name)
+        if not file_path.endswith('.csv') and os.path.exists(file_path):
+            save_csv(read_table(file_path), _csv_path(file_path))
 
 
 def read_static_info(file_path):
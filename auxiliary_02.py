@@ -18,10 +18,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import requests
+import hashlib
 import os
 import json
+import queue
+import re
+import shutil
+import threading
+import time
 import webbrowser
-from urllib.parse import quote, unquote
+from urllib.parse import quote, unquote, urlparse
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import logging
@@ -29,9 +35,26 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 DOI_URL_PREFIX = 'https://doi.org/'
+UNPAYWALL_API_URL = 'https://api.unpaywall.org/v2/'
 
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Minimum seconds between two requests to the same host; the APIs hit for every DOI allow a faster pace
+DOWNLOAD_HOST_INTERVAL = float(os.environ.get('DOWNLOAD_HOST_INTERVAL', 0.5))
+HOST_INTERVALS = {'api.unpaywall.org': 0.1, 'doi.org': 0.1}
 
-def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504)):
+# Unpaywall answers and DOI resolutions are cached on disk; failed lookups are retried sooner
+CACHE_TTL = float(os.environ.get('DOWNLOAD_CACHE_TTL_DAYS', 30)) * 86400
+CACHE_NEGATIVE_TTL = float(os.environ.get('DOWNLOAD_CACHE_NEGATIVE_TTL_DAYS', 1)) * 86400
+CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_MB', 256)) * 1024 * 1024
+CACHE_EVICT_EVERY = 500
+CACHE_MISS = object()
+
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get('DOWNLOAD_CHUNK_KB', 1024)) * 1024
+# Pages of PDFs that could not be downloaded are opened in the browser, at most this many per run
+DOWNLOAD_BROWSER_TABS = int(os.environ.get('DOWNLOAD_BROWSER_TABS', 20))
+
+
+def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504), pool_maxsize=10):
     session = requests.Session()
     retry = Retry(
         total=retries,
@@ -40,74 +63,350 @@ def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
-# Download PDF from URL
-def download_pdf(url, dest_folder):
+_session = None
+_session_lock = threading.Lock()
+
+
+# One pooled session shared by every download thread, so connections to a host are reused
+def shared_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests_retry_session(pool_maxsize=DOWNLOAD_WORKERS)
+        return _session
+
+
+# Spaces out requests to each host; threads reserve their slot under the lock and sleep outside it
+class HostRateLimiter:
+
+    def __init__(self, interval=DOWNLOAD_HOST_INTERVAL, intervals=HOST_INTERVALS):
+        self.interval = interval
+        self.intervals = intervals
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc.lower()
+        interval = self.intervals.get(host, self.interval)
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiter = HostRateLimiter()
+
+
+# Content-addressed JSON cache: each (kind, key) pair is stored in its own file named after its hash.
+# A None value records a negative result, which expires after negative_ttl instead of ttl.
+class ResponseCache:
+
+    def __init__(self, path, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.writes = 0
+        os.makedirs(path, exist_ok=True)
+        self.evict()
+
+    def _file(self, kind, key):
+        digest = hashlib.sha256(f"{kind}\x1f{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], f"{digest}.json")
+
+    def get(self, kind, key):
+        file_path = self._file(kind, key)
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return CACHE_MISS
+        ttl = self.negative_ttl if entry['value'] is None else self.ttl
+        if time.time() - entry['stored'] > ttl:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            return CACHE_MISS
+        return entry['value']
+
+    def put(self, kind, key, value):
+        file_path = self._file(kind, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'kind': kind, 'key': key, 'stored': time.time(), 'value': value}, file)
+        os.replace(tmp_path, file_path)
+
+        with self.lock:
+            self.writes += 1
+            evict = self.writes % CACHE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    # Drops expired entries, then the least recently written ones until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        now = time.time()
+        for folder, _, files in os.walk(self.path):
+            for name in files:
+                file_path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > max(self.ttl, self.negative_ttl):
+                    os.remove(file_path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, file_path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Completed downloads by file, with the URL each came from, so reruns skip PDFs that are already on disk.
+# Several DOIs can resolve to the same URL; the file of the first is then copied for the others.
+class DownloadManifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                entries = json.load(file)
+            # Manifests written before were keyed by URL
+            for key, entry in entries.items():
+                entry.setdefault('url', key)
+                self.entries[entry['path']] = entry
+
+    # A file that was removed or changed size since is downloaded again
+    def _valid(self, entry):
+        return entry is not None and os.path.exists(entry['path']) and os.path.getsize(entry['path']) == entry['size']
+
+    def completed(self, path, url):
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None or entry['url'] != url or not self._valid(entry):
+            return None
+        return entry
+
+    # A completed download of url to any other file
+    def downloaded(self, url):
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if entry['url'] == url]
+        return next((entry for entry in entries if self._valid(entry)), None)
+
+    def add(self, url, path, size, sha256):
+        with self.lock:
+            self.entries[path] = {'path': path, 'url': url, 'size': size, 'sha256': sha256,
+                                  'downloaded_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self.entries, file, indent=4)
+            os.replace(tmp_path, self.path)
+
+
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(DOWNLOAD_CHUNK_BYTES), b''):
+            digest.update(block)
+    return digest
+
+
+# A file name for the PDF of a DOI, or of a URL with no DOI. Publisher links often end in the same
+# segment (/pdf, /download, /fulltext), so a URL's name carries a hash of the whole URL.
+def pdf_filename(url, doi=None):
+    if doi is not None:
+        return re.sub(r'[^\w.-]', '_', doi) + '.pdf'
+    stem = re.sub(r'[^\w.-]', '_', unquote(urlparse(url).path.rstrip('/').split('/')[-1]))[:80]
+    stem = stem[:-4] if stem.lower().endswith('.pdf') else stem
+    return f"{stem or 'download'}-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]}.pdf"
+
+
+# Download PDF from URL. The body goes to a .part file that is renamed once complete;
+# a .part left by an interrupted run of the same URL is resumed with an HTTP Range request.
+def download_pdf(url, dest_folder, session=None, manifest=None, filename=None):
+    pdf_path = os.path.join(dest_folder, filename or pdf_filename(url))
     headers = {
         'Accept': 'application/pdf',
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
-    session = requests_retry_session()
+    session = session or shared_session()
 
-    try:
-        response = session.get(url, headers=headers, stream=True, timeout=20)
-        content_type = response.headers.get('Content-Type', '')
-
-        if 'application/pdf' in content_type:
-            filename = unquote(url.split('/')[-1])
-            if not filename.endswith('.pdf'):
-                filename += '.pdf'
-
-            pdf_path = os.path.join(dest_folder, filename)
-            with open(pdf_path, 'wb') as pdf_file:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        pdf_file.write(chunk)
-            logging.info(f'     Downloaded: {pdf_path}')
-            return True
+    with path_lock(pdf_path):
+        if manifest is not None:
+            entry = manifest.completed(pdf_path, url)
+            if entry is not None:
+                logging.info(f'     Already downloaded: {entry["path"]}')
+                return True
+            entry = manifest.downloaded(url)
+            if entry is not None:
+                tmp_path = f"{pdf_path}.tmp"
+                shutil.copyfile(entry['path'], tmp_path)
+                os.replace(tmp_path, pdf_path)
+                manifest.add(url, pdf_path, entry['size'], entry['sha256'])
+                logging.info(f'     Already downloaded as {entry["path"]}, copied to {pdf_path}')
+                return True
+        return _download_to(url, pdf_path, headers, session, manifest)
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+# Only one worker thread at a time writes a given file
+def path_lock(file_path):
+    with _path_locks_lock:
+        return _path_locks.setdefault(os.path.abspath(file_path), threading.Lock())
+
+
+def _download_to(url, pdf_path, headers, session, manifest):
+    part_path = f"{pdf_path}.part"
+    # The URL a .part file came from; bytes from another URL must never be appended to it
+    source_path = f"{pdf_path}.part.url"
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset:
+        source = None
+        if os.path.exists(source_path):
+            with open(source_path, encoding='utf-8') as file:
+                source = file.read()
+        if source == url:
+            headers['Range'] = f'bytes={offset}-'
         else:
-            logging.warning(f'     Content at URL is not a PDF: {url}')
-            return False
+            offset = 0
+
+    try:
+        rate_limiter.wait(url)
+        with session.get(url, headers=headers, stream=True, timeout=20) as response:
+            content_type = response.headers.get('Content-Type', '')
+
+            if response.status_code == 206 and offset and 'application/pdf' in content_type \
+                    and not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                # A range other than the one asked for: the partial file is dropped and the whole file fetched
+                logging.warning(f'     Unexpected range from {url}, downloading it again')
+                _remove_part(part_path, source_path)
+                headers.pop('Range', None)
+            elif response.status_code in (200, 206) and 'application/pdf' in content_type:
+                if response.status_code == 206:
+                    digest = _file_sha256(part_path)
+                    logging.info(f'     Resuming {pdf_path} from byte {offset}')
+                else:
+                    # A full body, also when the server ignored the Range header
+                    offset = 0
+                    digest = hashlib.sha256()
+                    with open(source_path, 'w', encoding='utf-8') as file:
+                        file.write(url)
+
+                expected = response.headers.get('Content-Length')
+                expected = offset + int(expected) if expected is not None and 'Content-Encoding' not in response.headers else None
+
+                with open(part_path, 'ab' if offset else 'wb') as pdf_file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        if chunk:
+                            pdf_file.write(chunk)
+                            digest.update(chunk)
+
+                size = os.path.getsize(part_path)
+                if expected is not None and size != expected:
+                    logging.warning(f'     Incomplete download of {url} ({size} of {expected} bytes), will resume on the next run')
+                    return False
+
+                os.replace(part_path, pdf_path)
+                os.remove(source_path)
+                if manifest is not None:
+                    manifest.add(url, pdf_path, size, digest.hexdigest())
+                logging.info(f'     Downloaded: {pdf_path}')
+                return True
+            else:
+                if response.status_code == 416:
+                    # The partial file does not match what the server has; the next attempt starts over
+                    _remove_part(part_path, source_path)
+                logging.warning(f'     Content at URL is not a PDF: {url}')
+                return False
     except Exception as e:
         logging.error(f'     Error downloading PDF from {url}: {e}')
         return False
+    return _download_to(url, pdf_path, headers, session, manifest)
+
 
+def _remove_part(part_path, source_path):
+    for path in (part_path, source_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def resolve_doi(doi, session=None, cache=None):
+    if cache is not None:
+        cached = cache.get('doi', doi)
+        if cached is not CACHE_MISS:
+            return cached
 
-def resolve_doi(doi):
     headers = {
         'Accept': 'application/pdf, application/json;q=0.9, */*;q=0.8',
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
-    doi_url = f'https://doi.org/{quote(doi)}'
-    session = requests_retry_session()
+    doi_url = f'{DOI_URL_PREFIX}{quote(doi)}'
+    session = session or shared_session()
 
     try:
+        rate_limiter.wait(doi_url)
         response = session.head(doi_url, headers=headers, allow_redirects=True, timeout=10)
         if response.status_code == 200:
             final_url = response.url
             logging.info(f'     DOI resolved to URL: {final_url}')
+            if cache is not None:
+                cache.put('doi', doi, final_url)
             return final_url
         else:
             logging.warning(f'     Failed to resolve DOI {doi}: HTTP {response.status_code}')
+            if cache is not None and response.status_code < 500:
+                cache.put('doi', doi, None)
             return None
     except Exception as e:
         logging.error(f'     Error resolving DOI {doi}: {e}')
     return None
 
 
-def fetch_unpaywall_data(doi, email):
-    url = f"https://api.unpaywall.org/v2/{doi}?email={email}"
+def fetch_unpaywall_data(doi, email, session=None, cache=None):
+    if cache is not None:
+        cached = cache.get('unpaywall', doi)
+        if cached is not CACHE_MISS:
+            return cached
+
+    url = f"{UNPAYWALL_API_URL}{doi}?email={email}"
+    session = session or shared_session()
     try:
-        response = requests.get(url, timeout=10)
+        rate_limiter.wait(url)
+        response = session.get(url, timeout=10)
         if response.status_code == 200:
-            return response.json()
+            data = response.json()
+            if cache is not None:
+                cache.put('unpaywall', doi, data)
+            return data
         else:
             logging.warning(f"     Error fetching projects for DOI {doi}: HTTP {response.status_code}")
+            # Server errors and dropped connections are not remembered, only answers about the DOI itself
+            if cache is not None and response.status_code < 500:
+                cache.put('unpaywall', doi, None)
             return None
     except requests.exceptions.RequestException as e:
         logging.error(f"     Request exception for DOI {doi}: {e}")
@@ -134,3 +433,92 @@ def find_pdf_links(data):
     logging.warning("     No PDF link found in Unpaywall projects")
     return None
 
+
+# Unpaywall first, then the publisher page the DOI resolves to; opens the page in a browser as a last resort.
+# Worker threads pass their own browse function, so pages are opened from the main thread afterwards.
+def retrieve_pdf(doi, inclusion_importance, save_folder, pdf_folder, email, cache=None, manifest=None,
+                 browse=webbrowser.open_new_tab):
+    logging.info(f'     Processing DOI: {doi} with Inclusion Importance: {inclusion_importance}')
+
+    importance_folder = os.path.join(save_folder, f"Importance_{inclusion_importance}")
+    importance_pdf_folder = os.path.join(pdf_folder, f"Importance_{inclusion_importance}")
+
+    os.makedirs(importance_folder, exist_ok=True)
+    os.makedirs(importance_pdf_folder, exist_ok=True)
+
+    data = fetch_unpaywall_data(doi, email, cache=cache)
+    if data:
+        save_unpaywall_data(doi, data, importance_folder)
+        pdf_url = find_pdf_links(data)
+        if pdf_url:
+            if download_pdf(pdf_url, importance_pdf_folder, manifest=manifest, filename=pdf_filename(pdf_url, doi)):
+                return True
+
+    resolved_url = resolve_doi(doi, cache=cache)
+    if resolved_url:
+        if download_pdf(resolved_url, importance_pdf_folder, manifest=manifest, filename=pdf_filename(resolved_url, doi)):
+            return True
+        else:
+            browse(resolved_url)
+    else:
+        logging.warning(f'Could not resolve DOI: {doi}')
+        browse(f"{DOI_URL_PREFIX}{doi}")
+    return False
+
+
+def _priority(inclusion_importance):
+    try:
+        return -float(inclusion_importance)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# Retrieves every DOI with a pool of worker threads; the most important inclusions are taken off the queue first
+def download_inclusions(dois_df, save_folder, pdf_folder, email, workers=DOWNLOAD_WORKERS, cache=None):
+    jobs = queue.PriorityQueue()
+    for order, (doi, inclusion_importance) in enumerate(zip(dois_df['DOI'], dois_df['Inclusion_Importance'])):
+        jobs.put((_priority(inclusion_importance), order, doi, inclusion_importance))
+
+    manifest = DownloadManifest(os.path.join(pdf_folder, 'pdf_manifest.json'))
+    results = {}
+    to_browse = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                priority, order, doi, inclusion_importance = jobs.get_nowait()
+            except queue.Empty:
+                return
+
+            def browse(url):
+                with results_lock:
+                    to_browse.append((priority, order, url))
+
+            try:
+                downloaded = retrieve_pdf(doi, inclusion_importance, save_folder, pdf_folder, email, cache, manifest,
+                                          browse)
+            except Exception:
+                logging.exception(f'     Failed to retrieve DOI: {doi}')
+                downloaded = False
+            with results_lock:
+                results[doi] = downloaded
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f'download-{i}') for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    logging.info(f'     Downloaded {sum(results.values())} of {len(results)} PDFs '
+                 f'with {len(threads)} workers in {time.perf_counter() - started:.1f}s')
+
+    # The most important inclusions first; the rest are only listed
+    urls = list(dict.fromkeys(url for _, _, url in sorted(to_browse)))
+    for url in urls[:DOWNLOAD_BROWSER_TABS]:
+        logging.info(f'Opening URL in browser: {url}')
+        webbrowser.open_new_tab(url)
+    for url in urls[DOWNLOAD_BROWSER_TABS:]:
+        logging.warning(f'Not opened, over DOWNLOAD_BROWSER_TABS: {url}')
+    return results
@@ -0,0 +1,383 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import html
+import json
+import os
+import re
+import shutil
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from urllib.parse import unquote
+
+NO_ABSTRACT = "[No abstract available]"
+AVOID_FIELDS = ['ISSN']
+DECISION_FIELDS = ['Inclusion_Importance', 'Exclusion_Reason']
+TITLE_FIELDS = ['Title', 'Document Title']
+KEY_FIELDS = ['DOI_Key', 'Abstract_Key', 'Title_Key']
+# Version of the key scheme behind dedup_index.csv; indexes built with another version are rebuilt
+KEYS_VERSION = 4
+NUMBER = re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?$')
+DOI_PREFIX = re.compile(r'^(?:https?://)?(?:dx\.)?doi\.org/|^doi:\s*')
+
+# Records whose title/abstract MinHash similarity reaches this value are near-duplicates; 1 or more disables the stage
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get('NEAR_DUPLICATE_THRESHOLD', 0.8))
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 3
+
+_permutations = np.random.default_rng(23).integers(1, 2 ** 63, size=(2, MINHASH_PERMUTATIONS), dtype=np.uint64)
+MINHASH_A = _permutations[0] | np.uint64(1)
+MINHASH_B = _permutations[1]
+
+
+def hash_key(value):
+    return hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).hexdigest()
+
+
+# Numbers compare after rounding, everything else as stripped text; empty fields are skipped.
+# Sources are read as text and the working files with guessed types, so "12" and 12 are the same number.
+def normalise_field(value):
+    if pd.isna(value):
+        return None
+    if isinstance(value, (int, float)) and np.isfinite(value):
+        return f"n{round(float(value))}"
+    text = str(value).strip()
+    if NUMBER.match(text) and np.isfinite(float(text)):
+        return f"n{round(float(text))}"
+    return f"s{text}"
+
+
+# Two records share a fingerprint when every non-empty field outside avoid_fields matches;
+# KEY_FIELDS are derived from the other fields, so they never take part
+def fingerprints(df, avoid_fields=AVOID_FIELDS):
+    combined = pd.Series('', index=df.index, dtype=object)
+    for field in sorted(df.columns):
+        if field in avoid_fields or field in KEY_FIELDS:
+            continue
+        values = df[field].astype(object).map(normalise_field)
+        combined = combined + values.map(lambda value: '' if value is None else f"{field}\x1f{value}\x1e")
+    return combined.map(hash_key)
+
+
+def normalise_text(text):
+    text = html.unescape(str(text))
+    text = re.sub(r'<[^>]+>', ' ', text)
+    return re.sub(r'[\W_]+', ' ', text.lower()).strip()
+
+
+# Lower-cased DOI without resolver or "doi:" prefixes, so every export of one paper yields the same key
+def canonical_doi(doi):
+    if pd.isna(doi):
+        return None
+    doi = unquote(str(doi)).strip().lower()
+    doi = DOI_PREFIX.sub('', doi).strip()
+    return doi or None
+
+
+# The DOI arXiv registers for every preprint, which keys arXiv records that have no journal DOI
+def arxiv_doi(arxiv_id):
+    if pd.isna(arxiv_id):
+        return None
+    arxiv_id = re.sub(r'^arxiv:|v\d+$', '', str(arxiv_id).strip().lower())
+    return f"10.48550/arxiv.{arxiv_id}" if arxiv_id else None
+
+
+def text_key(text):
+    if pd.isna(text):
+        return None
+    text = normalise_text(text)
+    return hash_key(text) if text else None
+
+
+def _column(df, field):
+    if field not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    return df[field].astype(object)
+
+
+# Canonical DOI plus hashes of the normalised title and abstract, computed once when a record is ingested
+# and stored with it in KEY_FIELDS; every later stage reads them back instead of normalising again
+def add_key_columns(df):
+    df = df.copy()
+    title_field = next((field for field in TITLE_FIELDS if field in df.columns), None)
+    abstracts = _column(df, 'Abstract')
+    dois = _column(df, 'DOI').map(canonical_doi)
+    df['DOI_Key'] = dois.where(dois.notna(), _column(df, 'arXiv ID').map(arxiv_doi))
+    df['Abstract_Key'] = abstracts.where(abstracts != NO_ABSTRACT).map(text_key)
+    df['Title_Key'] = _column(df, title_field or 'Title').map(text_key)
+    return df
+
+
+# Stored keys where the record has them; rows written before the key columns existed are keyed on the fly
+def key_columns(df):
+    keys = df.reindex(columns=KEY_FIELDS).astype(object)
+    keys = keys.where(keys.notna(), None)
+    missing = keys.isna().all(axis=1)
+    if missing.any():
+        keys[missing] = add_key_columns(df[missing])[KEY_FIELDS]
+    return keys
+
+
+def record_keys(df, avoid_fields=AVOID_FIELDS):
+    keys = key_columns(df)
+    return pd.DataFrame({
+        'doi': keys['DOI_Key'],
+        'abstract': keys['Abstract_Key'],
+        'fingerprint': fingerprints(df, avoid_fields),
+    }, index=df.index)
+
+
+class DedupIndex:
+
+    def __init__(self, avoid_fields=AVOID_FIELDS):
+        self.avoid_fields = set(avoid_fields)
+        self.dois = set()
+        self.abstracts = set()
+        self.fingerprints = set()
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def contains(self, doi, abstract, fingerprint):
+        return (
+                (pd.notna(doi) and doi in self.dois) or
+                (pd.notna(abstract) and abstract in self.abstracts) or
+                fingerprint in self.fingerprints
+        )
+
+    def add(self, doi, abstract, fingerprint):
+        if pd.notna(doi):
+            self.dois.add(doi)
+        if pd.notna(abstract):
+            self.abstracts.add(abstract)
+        self.fingerprints.add(fingerprint)
+
+    def add_keys(self, keys):
+        self.dois.update(keys['doi'].dropna())
+        self.abstracts.update(keys['abstract'].dropna())
+        self.fingerprints.update(keys['fingerprint'])
+
+    def add_dataframe(self, df):
+        keys = record_keys(df.drop(columns=DECISION_FIELDS, errors='ignore'), self.avoid_fields)
+        self.add_keys(keys)
+        return keys
+
+    # Returns a boolean mask over keys marking records already indexed or repeated earlier in keys;
+    # the records that are not duplicates are added to the index as they are seen
+    def mark_duplicates(self, keys):
+        is_duplicate = []
+        for doi, abstract, fingerprint in keys[['doi', 'abstract', 'fingerprint']].itertuples(index=False):
+            duplicate = self.contains(doi, abstract, fingerprint)
+            if not duplicate:
+                self.add(doi, abstract, fingerprint)
+            is_duplicate.append(duplicate)
+
+        return pd.Series(is_duplicate, index=keys.index, dtype=bool)
+
+    @classmethod
+    def load(cls, file_path, avoid_fields=AVOID_FIELDS):
+        index = cls(avoid_fields)
+        index.add_keys(pd.read_csv(file_path, dtype=str))
+        return index
+
+
+# Title and abstract of each record, normalised, for near-duplicate matching
+def record_texts(df):
+    texts = pd.Series('', index=df.index, dtype=object)
+    title_field = next((field for field in TITLE_FIELDS if field in df.columns), None)
+    if title_field is not None:
+        texts = texts + df[title_field].fillna('').astype(str) + ' '
+    if 'Abstract' in df.columns:
+        texts = texts + df['Abstract'].where(df['Abstract'] != NO_ABSTRACT).fillna('').astype(str)
+    return texts.map(normalise_text)
+
+
+def minhash_signature(text):
+    words = text.split()
+    if len(words) < SHINGLE_WORDS:
+        return None
+    shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    with np.errstate(over='ignore'):
+        permuted = (MINHASH_A[:, None] * hashes[None, :] + MINHASH_B[:, None]) >> np.uint64(32)
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+# Picks the LSH band layout whose similarity threshold is closest to the requested one
+def lsh_bands(threshold, num_perm=MINHASH_PERMUTATIONS):
+    layouts = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(layouts, key=lambda layout: abs((1 / layout[0]) ** (1 / layout[1]) - threshold))
+
+
+# MinHash signatures bucketed by LSH band, so near-duplicate candidates come from dict lookups, not pairwise scans
+class NearDuplicateIndex:
+
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(min(threshold, 1.0))
+        self.buckets = [{} for _ in range(self.bands)]
+        self.ids = []
+        self.signatures = []
+        self.saved = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def enabled(self):
+        return self.threshold < 1
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, record_id, signature):
+        position = len(self.ids)
+        self.ids.append(record_id)
+        self.signatures.append(signature)
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(position)
+
+    def query(self, signature):
+        candidates = set()
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+
+        best_id, best_score = None, 0.0
+        for position in candidates:
+            score = float(np.mean(self.signatures[position] == signature))
+            if score > best_score:
+                best_id, best_score = self.ids[position], score
+        return (best_id, best_score) if best_score >= self.threshold else (None, best_score)
+
+    def add_dataframe(self, df, ids):
+        for record_id, text in zip(ids, record_texts(df)):
+            signature = minhash_signature(text)
+            if signature is not None:
+                self.add(record_id, signature)
+
+    # Returns the matched record ID and score for each record of df[mask] that is a near-duplicate;
+    # the records that are not are added to the index as they are seen
+    def mark_near_duplicates(self, df, ids, mask):
+        matched_ids = pd.Series(None, index=df.index, dtype=object)
+        scores = pd.Series(np.nan, index=df.index, dtype=float)
+        if not self.enabled:
+            return pd.DataFrame({'Duplicate_Of': matched_ids, 'Duplicate_Score': scores})
+
+        for idx, text in record_texts(df[mask]).items():
+            signature = minhash_signature(text)
+            if signature is None:
+                continue
+            match, score = self.query(signature)
+            if match is not None:
+                matched_ids[idx] = match
+                scores[idx] = round(score, 3)
+            else:
+                self.add(ids[idx], signature)
+
+        return pd.DataFrame({'Duplicate_Of': matched_ids, 'Duplicate_Score': scores})
+
+    def save(self, file_path):
+        self._write(file_path, self.ids, self.signatures)
+        self.saved = len(self.ids)
+        if os.path.isdir(f"{file_path}.parts"):
+            shutil.rmtree(f"{file_path}.parts")
+
+    # Entries added since the last save go to a part file of their own, which load reads until the next save
+    def save_part(self, file_path):
+        parts_dir = f"{file_path}.parts"
+        os.makedirs(parts_dir, exist_ok=True)
+        self._write(os.path.join(parts_dir, f"{len(os.listdir(parts_dir)):06d}.npz"),
+                    self.ids[self.saved:], self.signatures[self.saved:])
+        self.saved = len(self.ids)
+
+    @staticmethod
+    def _write(file_path, ids, signatures):
+        signatures = np.array(signatures, dtype=np.uint32).reshape(-1, MINHASH_PERMUTATIONS)
+        with open(f"{file_path}.tmp", 'wb') as file:
+            np.savez(file, ids=np.array(ids, dtype=str), signatures=signatures)
+        os.replace(f"{file_path}.tmp", file_path)
+
+    @classmethod
+    def load(cls, file_path, threshold=NEAR_DUPLICATE_THRESHOLD):
+        index = cls(threshold)
+        parts_dir = f"{file_path}.parts"
+        parts = sorted(name for name in os.listdir(parts_dir) if name.endswith('.npz')) if os.path.isdir(parts_dir) else []
+        for path in [file_path] + [os.path.join(parts_dir, name) for name in parts]:
+            with np.load(path) as data:
+                for record_id, signature in zip(data['ids'], data['signatures']):
+                    index.add(str(record_id), signature)
+        index.saved = len(index)
+        return index
+
+
+def append_keys(keys, file_path):
+    keys.to_csv(file_path, mode='a', header=not os.path.exists(file_path), index=False)
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Records which source files (by content hash) have already been ingested into a project
+def load_manifest(file_path):
+    if not os.path.exists(file_path):
+        return {"files": {}}
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, file_path):
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+def add_to_manifest(manifest, file_path, digest, rows, profile=None):
+    manifest["files"][digest] = {
+        "name": os.path.basename(file_path),
+        "rows": rows,
+        "profile": profile,
+        "ingested_at": datetime.now().isoformat(timespec='seconds')
+    }
+
+
+# Returns a boolean mask over unique_df marking records that already have an inclusion/exclusion decision.
+# Decision files carry extra columns, so fingerprints compare on the columns of unique_df only.
+def find_decided(unique_df, decision_dfs, avoid_fields=AVOID_FIELDS):
+    keys = record_keys(unique_df, avoid_fields)
+    is_decided = pd.Series(False, index=unique_df.index, dtype=bool)
+
+    for decision_df in decision_dfs:
+        if decision_df.empty:
+            continue
+        decision_df = decision_df.drop(columns=DECISION_FIELDS, errors='ignore')
+        decision_keys = key_columns(decision_df).rename(columns={'DOI_Key': 'doi', 'Abstract_Key': 'abstract'})
+        decision_keys['fingerprint'] = fingerprints(decision_df.reindex(columns=unique_df.columns), avoid_fields)
+        for key in keys.columns:
+            is_decided |= keys[key].isin(decision_keys[key].dropna())
+
+    return is_decided
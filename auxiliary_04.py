@@ -0,0 +1,748 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import sqlite3
+import threading
+import time
+from itertools import islice
+from auxiliary_01 import *
+from auxiliary_03 import fingerprints, KEY_FIELDS
+from auxiliary_07 import *
+
+JOURNAL_COMPACT_EVERY = 100
+# memory keeps a project in the process and journals decisions; sqlite keeps it in the project's review.db,
+# which several app worker processes can share
+REVIEW_STORE = os.environ.get('REVIEW_STORE', 'memory')
+# Records checked out by a reviewer return to the queue when not decided within this many seconds
+LEASE_SECONDS = int(os.environ.get('REVIEW_LEASE_SECONDS', 300))
+# Every decision takes the record out of the queue for good; a record to come back to is left pending instead
+DECISION_ACTIONS = ('include', 'exclude')
+
+
+class LeaseConflict(Exception):
+    pass
+
+
+# Record IDs are the record fingerprints, so they stay the same across restarts and compactions;
+# the rare exact copies within all_data get a numbered suffix
+def record_ids(record_fingerprints):
+    seen = {}
+    ids = []
+    for fingerprint in record_fingerprints:
+        copies = seen.get(fingerprint, 0)
+        seen[fingerprint] = copies + 1
+        ids.append(fingerprint if copies == 0 else f"{fingerprint}-{copies}")
+    return ids
+
+
+# Append-only log of decisions; every entry is fsync'd before the request returns
+class DecisionJournal:
+
+    def __init__(self, path):
+        self.path = path
+        self.compacting_path = f"{path}.compacting"
+        self.file = None
+        self.count = 0
+
+    def entries(self):
+        entries = []
+        for path in (self.compacting_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write
+                        break
+        return entries
+
+    def append(self, entry):
+        self.append_many([entry])
+
+    # A batch costs a single fsync
+    def append_many(self, entries):
+        if not entries:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += len(entries)
+
+    # Moves the current entries aside so new decisions can keep landing while the CSVs are rewritten
+    def rotate(self):
+        self.close()
+        if os.path.exists(self.path):
+            if os.path.exists(self.compacting_path):
+                with open(self.path, 'r', encoding='utf-8') as src, open(self.compacting_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.compacting_path)
+        self.count = 0
+
+    def finish_compaction(self):
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Working set of one project, loaded once and kept in memory while the app runs
+class ReviewStore:
+
+    def __init__(self, project):
+        self.project = project
+        self.all_data_file = get_table_path(project, 'all_data')
+        self.inclusions_file = get_table_path(project, 'inclusions')
+        self.exclusions_file = get_table_path(project, 'exclusions')
+        self.duplicates_file = get_table_path(project, 'duplicates')
+        self.journal = DecisionJournal(get_project_path(project, 'decisions.jsonl'))
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with instrument('review_store_load', self.project) as measurement:
+            self._load()
+            measurement['rows'] = len(self.pending) + len(self.inclusions) + len(self.exclusions)
+
+    def _load(self):
+        all_data_df = read_table(self.all_data_file)
+        inclusions_df = read_table(self.inclusions_file)
+        exclusions_df = read_table(self.exclusions_file)
+
+        with self.lock:
+            self.columns = list(all_data_df.columns)
+            record_fingerprints = list(fingerprints(all_data_df))
+            ids = record_ids(record_fingerprints)
+            self.pending = dict(zip(ids, all_data_df.to_dict('records')))
+            self.fingerprints = dict(zip(ids, record_fingerprints))
+            self.leases = {}
+            self.inclusions_columns = list(inclusions_df.columns)
+            self.inclusions = inclusions_df.to_dict('records')
+            self.exclusions_columns = list(exclusions_df.columns)
+            self.exclusions = exclusions_df.to_dict('records')
+            self.duplicates_count = count_rows(self.duplicates_file)
+            self.search_index = None
+            self.replay_journal()
+            self.search_index = self._build_search_index()
+
+    # Re-applies decisions that were journaled but not yet compacted into the CSVs
+    def replay_journal(self):
+        entries = self.journal.entries()
+        if not entries:
+            return
+
+        decided_df = pd.concat([pd.DataFrame(self.inclusions), pd.DataFrame(self.exclusions)], ignore_index=True)
+        already_saved = set(fingerprints(decided_df.reindex(columns=self.columns)))
+        keys = {fingerprint: key for key, fingerprint in self.fingerprints.items()}
+
+        for entry in entries:
+            key = keys.get(entry['fingerprint'])
+            if key is None or key not in self.pending:
+                continue
+            if entry['fingerprint'] in already_saved:
+                # Compaction wrote the decision file but stopped before all_data.csv
+                self.pending.pop(key)
+                self.fingerprints.pop(key)
+                continue
+            self._apply(key, entry['action'], entry.get('inclusion_importance'), entry.get('exclusion_reason'))
+
+        self.journal.count = len(entries)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def counts(self):
+        return {
+            "total_records": len(self.pending),
+            "included_count": len(self.inclusions),
+            "excluded_count": len(self.exclusions),
+            "duplicates_count": self.duplicates_count
+        }
+
+    def _key_at(self, position):
+        return next(islice(self.pending, position, None), None)
+
+    # The key columns are for matching only and are not shown to the reviewer
+    def _visible(self, key):
+        return {field: (None if value is pd.NA else value) for field, value in self.pending[key].items()
+                if field not in KEY_FIELDS}
+
+    def record(self, position=0):
+        with self.lock:
+            key = self._key_at(position)
+            if key is None:
+                return None
+            return self._visible(key)
+
+    def _lease_holder(self, record_id, now):
+        lease = self.leases.get(record_id)
+        if lease is None or lease[1] <= now:
+            return None
+        return lease[0]
+
+    # Leases up to limit pending records that nobody else holds to reviewer, as (record_id, record) pairs.
+    # Also renews the reviewer's current leases and reclaims everyone's expired ones.
+    def checkout(self, reviewer, limit=20, lease_seconds=LEASE_SECONDS):
+        with self.lock:
+            now = time.time()
+            expires = now + lease_seconds
+            for record_id, (holder, until) in list(self.leases.items()):
+                if holder == reviewer:
+                    self.leases[record_id] = (reviewer, expires)
+                elif until <= now:
+                    del self.leases[record_id]
+
+            window = []
+            for record_id in self.pending:
+                if len(window) >= limit:
+                    break
+                if record_id not in self.leases:
+                    self.leases[record_id] = (reviewer, expires)
+                    window.append((record_id, self._visible(record_id)))
+            return window
+
+    # Gives back the reviewer's leases on record_ids, or all of them, e.g. when the page is closed or reloaded
+    def release(self, reviewer, record_ids=None):
+        with self.lock:
+            for record_id in list(self.leases if record_ids is None else record_ids):
+                if record_id in self.leases and self.leases[record_id][0] == reviewer:
+                    del self.leases[record_id]
+
+    def _apply(self, key, action, inclusion_importance, exclusion_reason):
+        record = dict(self.pending.pop(key))
+        self.fingerprints.pop(key)
+
+        if action == "include":
+            record["Inclusion_Importance"] = inclusion_importance
+            self.inclusions.append(record)
+        elif action == "exclude":
+            record["Exclusion_Reason"] = exclusion_reason
+            self.exclusions.append(record)
+
+        if self.search_index is not None:
+            self.search_index.move(key, {"include": "inclusions", "exclude": "exclusions"}.get(action), record)
+        return record
+
+    # Built once the journal is replayed, and kept up to date by _apply from then on
+    def _build_search_index(self):
+        index = SearchIndex()
+        for position, (key, record) in enumerate(self.pending.items()):
+            index.add(key, 'all_data', position, record)
+        for table, records in (('inclusions', self.inclusions), ('exclusions', self.exclusions)):
+            for position, record in enumerate(records):
+                index.add(f"{table}:{position}", table, position, record)
+        duplicates_df = read_table(self.duplicates_file, columns=list(dict.fromkeys(SEARCH_FIELDS + RESULT_FIELDS)))
+        for position, record in enumerate(duplicates_df.to_dict('records')):
+            index.add(f"duplicates:{position}", 'duplicates', position, record)
+        return index
+
+    # (total, [(table, record_id, record), ...]) for one page of the records matching query;
+    # record_id is only meaningful for records still in all_data
+    def search(self, query, tables=SEARCH_TABLES, offset=0, limit=20):
+        with self.lock:
+            return self.search_index.search(query, tables, offset, limit)
+
+    def decide(self, record_id, action, inclusion_importance=None, exclusion_reason=None, reviewer=None):
+        decided, missing, conflicts = self.decide_many([{
+            "record_id": record_id,
+            "action": action,
+            "inclusion_importance": inclusion_importance,
+            "exclusion_reason": exclusion_reason
+        }], reviewer)
+        if conflicts:
+            raise LeaseConflict(record_id)
+        if not decided:
+            raise IndexError(record_id)
+        return decided[0]
+
+    # Applies a batch of decisions under one lock and one journal write. Records that are no longer pending,
+    # e.g. from a batch the client sent twice, are returned as missing instead of being decided again;
+    # records another reviewer currently holds a lease on are returned as conflicts.
+    def decide_many(self, decisions, reviewer=None):
+        decided = []
+        missing = []
+        conflicts = []
+        with self.lock:
+            now = time.time()
+            entries = []
+            for decision in decisions:
+                key = decision["record_id"]
+                if key not in self.pending:
+                    missing.append(key)
+                    continue
+                holder = self._lease_holder(key, now)
+                if holder is not None and holder != reviewer:
+                    conflicts.append(key)
+                    continue
+                self.leases.pop(key, None)
+                fingerprint = self.fingerprints[key]
+                decided.append(self._apply(key, decision["action"], decision.get("inclusion_importance"),
+                                           decision.get("exclusion_reason")))
+                entries.append({
+                    "time": time.time(),
+                    "fingerprint": fingerprint,
+                    "action": decision["action"],
+                    "inclusion_importance": decision.get("inclusion_importance"),
+                    "exclusion_reason": decision.get("exclusion_reason"),
+                    "reviewer": reviewer
+                })
+            self.journal.append_many(entries)
+            compact = self.journal.count >= JOURNAL_COMPACT_EVERY and not self.compact_lock.locked()
+
+        if compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+        return decided, missing, conflicts
+
+    def inclusions_df(self):
+        return self._decisions_df(self.inclusions, self.inclusions_columns)
+
+    def exclusions_df(self):
+        return self._decisions_df(self.exclusions, self.exclusions_columns)
+
+    def all_data_df(self):
+        return pd.DataFrame(list(self.pending.values()), columns=self.columns)
+
+    def _decisions_df(self, records, columns):
+        df = pd.DataFrame(records)
+        return df.reindex(columns=columns + [c for c in df.columns if c not in columns])
+
+    # Folds the journal into the CSVs; the journal is only dropped once every file has been replaced
+    def compact(self):
+        with self.compact_lock:
+            with self.lock:
+                if self.journal.count == 0 and not os.path.exists(self.journal.compacting_path):
+                    return
+                pending = list(self.pending.values())
+                inclusions = list(self.inclusions)
+                exclusions = list(self.exclusions)
+                self.journal.rotate()
+
+            with instrument('review_store_compact', self.project, len(pending) + len(inclusions) + len(exclusions)):
+                save_table(self._decisions_df(inclusions, self.inclusions_columns), self.inclusions_file)
+                save_table(self._decisions_df(exclusions, self.exclusions_columns), self.exclusions_file)
+                save_table(pd.DataFrame(pending, columns=self.columns), self.all_data_file)
+            self.journal.finish_compaction()
+
+    def close(self):
+        self.compact()
+        self.journal.close()
+
+
+def _json_value(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    record_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    inclusion_importance INTEGER,
+    exclusion_reason TEXT,
+    reviewer TEXT,
+    decided_at REAL,
+    lease_holder TEXT,
+    lease_until REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_queue ON records (status, position);
+CREATE INDEX IF NOT EXISTS records_decided ON records (status, decided_at, position);
+CREATE INDEX IF NOT EXISTS records_lease ON records (lease_holder, lease_until);
+CREATE TABLE IF NOT EXISTS duplicates (
+    record_id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS records_search USING fts5(record_id UNINDEXED, text);
+CREATE VIRTUAL TABLE IF NOT EXISTS duplicates_search USING fts5(record_id UNINDEXED, text);
+"""
+
+
+# Same interface as ReviewStore, with the project kept in an SQLite database in WAL mode instead of in memory.
+# Every app worker process opens the same review.db, so decisions and leases are shared and each one is a
+# single-row transaction. The working files are imported when they change and written back by compact().
+class SqliteReviewStore:
+
+    def __init__(self, project):
+        self.project = project
+        self.all_data_file = get_table_path(project, 'all_data')
+        self.inclusions_file = get_table_path(project, 'inclusions')
+        self.exclusions_file = get_table_path(project, 'exclusions')
+        self.duplicates_file = get_table_path(project, 'duplicates')
+        self.database_file = get_project_path(project, 'review.db')
+        self.local = threading.local()
+        self.compact_lock = threading.Lock()
+        self.decided_since_compact = 0
+        self.load()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.executescript(SQLITE_SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        # Takes the write lock up front so two workers never deadlock upgrading a read
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _meta(self, connection, key, default=None):
+        row = connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, connection, key, value):
+        connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _signatures(self):
+        return {name: table_signature(path) for name, path in (
+            ('all_data', self.all_data_file), ('inclusions', self.inclusions_file),
+            ('exclusions', self.exclusions_file), ('duplicates', self.duplicates_file))}
+
+    def load(self):
+        with instrument('review_store_load', self.project) as measurement, project_lock(self.project):
+            self._import_changed()
+            measurement['rows'] = self._connection().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    # Imports the working files that changed since the last import or compaction. Rows are keyed by record ID,
+    # so rows already in the database, decided or not, are left as they are and only new records are added.
+    # Callers hold the project lock.
+    def _import_changed(self):
+        with self._transaction() as connection:
+            imported = self._meta(connection, 'imported')
+            signatures = self._signatures()
+            if not self._meta(connection, 'search_indexed'):
+                self._index_search(connection)
+
+            if any(signatures[name] != (imported or {}).get(name) for name in ('all_data', 'inclusions', 'exclusions')):
+                self._import_records(connection)
+            if signatures['duplicates'] != (imported or {}).get('duplicates'):
+                self._import_duplicates(connection)
+            if imported is None:
+                self._replay_journal(connection)
+
+            self._set_meta(connection, 'imported', signatures)
+
+    def _import_records(self, connection):
+        all_data_df = read_table(self.all_data_file)
+        inclusions_df = read_table(self.inclusions_file)
+        exclusions_df = read_table(self.exclusions_file)
+
+        columns = self._meta(connection, 'columns', [])
+        columns += [column for column in all_data_df.columns if column not in columns]
+        self._set_meta(connection, 'columns', columns)
+        for name, df in (('inclusions_columns', inclusions_df), ('exclusions_columns', exclusions_df)):
+            stored = self._meta(connection, name, [])
+            self._set_meta(connection, name, stored + [column for column in df.columns if column not in stored])
+
+        position = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM records").fetchone()[0]
+        # Decided records first, so a copy of one still in all_data keeps its decision
+        for status, df in (('include', inclusions_df), ('exclude', exclusions_df), ('pending', all_data_df)):
+            if df.empty:
+                continue
+            record_fingerprints = list(fingerprints(df.reindex(columns=columns)))
+            for record_id, fingerprint, record in zip(record_ids(record_fingerprints), record_fingerprints,
+                                                      df.to_dict('records')):
+                record = {field: _json_value(value) for field, value in record.items()}
+                importance = record.pop('Inclusion_Importance', None)
+                reason = record.pop('Exclusion_Reason', None)
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO records (record_id, fingerprint, position, status, inclusion_importance, "
+                    "exclusion_reason, decided_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (record_id, fingerprint, position, status, importance, reason,
+                     None if status == 'pending' else 0, json.dumps(record)))
+                if cursor.rowcount:
+                    connection.execute("INSERT INTO records_search (record_id, text) VALUES (?, ?)",
+                                       (record_id, search_text(record)))
+                position += 1
+
+    def _import_duplicates(self, connection):
+        duplicates_df = read_table(self.duplicates_file)
+        if duplicates_df.empty:
+            return
+        self._set_meta(connection, 'duplicates_columns', list(duplicates_df.columns))
+        position = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM duplicates").fetchone()[0]
+        duplicate_fingerprints = list(fingerprints(duplicates_df))
+        for record_id, record in zip(record_ids(duplicate_fingerprints), duplicates_df.to_dict('records')):
+            record = {field: _json_value(value) for field, value in record.items()}
+            cursor = connection.execute("INSERT OR IGNORE INTO duplicates (record_id, position, data) VALUES (?, ?, ?)",
+                                        (record_id, position, json.dumps(record)))
+            if cursor.rowcount:
+                connection.execute("INSERT INTO duplicates_search (record_id, text) VALUES (?, ?)",
+                                   (record_id, search_text(record)))
+            position += 1
+
+    # Fills the search tables for a database created before they existed
+    def _index_search(self, connection):
+        for table in ('records', 'duplicates'):
+            connection.execute(f"DELETE FROM {table}_search")
+            connection.executemany(f"INSERT INTO {table}_search (record_id, text) VALUES (?, ?)",
+                                   ((record_id, search_text(json.loads(data))) for record_id, data in
+                                    connection.execute(f"SELECT record_id, data FROM {table}").fetchall()))
+        self._set_meta(connection, 'search_indexed', True)
+
+    # Decisions a memory store journaled but never compacted, when a project switches to this store
+    def _replay_journal(self, connection):
+        for entry in DecisionJournal(get_project_path(self.project, 'decisions.jsonl')).entries():
+            connection.execute(
+                "UPDATE records SET status = ?, inclusion_importance = ?, exclusion_reason = ?, decided_at = ? "
+                "WHERE record_id = (SELECT record_id FROM records WHERE fingerprint = ? AND status = 'pending' "
+                "ORDER BY position LIMIT 1)",
+                (entry['action'], entry.get('inclusion_importance'), entry.get('exclusion_reason'), entry['time'],
+                 entry['fingerprint']))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM records WHERE status = 'pending'").fetchone()[0]
+
+    def counts(self):
+        connection = self._connection()
+        by_status = dict(connection.execute("SELECT status, COUNT(*) FROM records GROUP BY status").fetchall())
+        return {
+            "total_records": by_status.get('pending', 0),
+            "included_count": by_status.get('include', 0),
+            "excluded_count": by_status.get('exclude', 0),
+            "duplicates_count": connection.execute("SELECT COUNT(*) FROM duplicates").fetchone()[0]
+        }
+
+    # The key columns are for matching only and are not shown to the reviewer
+    def _visible(self, data):
+        return {field: value for field, value in json.loads(data).items() if field not in KEY_FIELDS}
+
+    def record(self, position=0):
+        row = self._connection().execute(
+            "SELECT data FROM records WHERE status = 'pending' ORDER BY position LIMIT 1 OFFSET ?",
+            (position,)).fetchone()
+        return None if row is None else self._visible(row[0])
+
+    # Leases up to limit pending records that nobody else holds to reviewer, as (record_id, record) pairs.
+    # Also renews the reviewer's current leases and reclaims everyone's expired ones.
+    def checkout(self, reviewer, limit=20, lease_seconds=LEASE_SECONDS):
+        with self._transaction() as connection:
+            now = time.time()
+            expires = now + lease_seconds
+            connection.execute("UPDATE records SET lease_until = ? WHERE lease_holder = ?", (expires, reviewer))
+            connection.execute("UPDATE records SET lease_holder = NULL, lease_until = NULL "
+                               "WHERE lease_holder IS NOT NULL AND lease_until <= ?", (now,))
+            rows = connection.execute(
+                "SELECT record_id, data FROM records WHERE status = 'pending' AND lease_holder IS NULL "
+                "ORDER BY position LIMIT ?", (limit,)).fetchall()
+            connection.executemany("UPDATE records SET lease_holder = ?, lease_until = ? WHERE record_id = ?",
+                                   [(reviewer, expires, record_id) for record_id, _ in rows])
+        return [(record_id, self._visible(data)) for record_id, data in rows]
+
+    # Gives back the reviewer's leases on record_ids, or all of them, e.g. when the page is closed or reloaded
+    def release(self, reviewer, record_ids=None):
+        with self._transaction() as connection:
+            if record_ids is None:
+                connection.execute("UPDATE records SET lease_holder = NULL, lease_until = NULL "
+                                   "WHERE lease_holder = ?", (reviewer,))
+            else:
+                connection.executemany("UPDATE records SET lease_holder = NULL, lease_until = NULL "
+                                       "WHERE record_id = ? AND lease_holder = ?",
+                                       [(record_id, reviewer) for record_id in record_ids])
+
+    def decide(self, record_id, action, inclusion_importance=None, exclusion_reason=None, reviewer=None):
+        decided, missing, conflicts = self.decide_many([{
+            "record_id": record_id,
+            "action": action,
+            "inclusion_importance": inclusion_importance,
+            "exclusion_reason": exclusion_reason
+        }], reviewer)
+        if conflicts:
+            raise LeaseConflict(record_id)
+        if not decided:
+            raise IndexError(record_id)
+        return decided[0]
+
+    # Applies a batch of decisions in one transaction, with the same missing and conflict rules as ReviewStore
+    def decide_many(self, decisions, reviewer=None):
+        decided = []
+        missing = []
+        conflicts = []
+        with self._transaction() as connection:
+            now = time.time()
+            for decision in decisions:
+                key = decision["record_id"]
+                row = connection.execute("SELECT status, lease_holder, lease_until, data FROM records "
+                                         "WHERE record_id = ?", (key,)).fetchone()
+                if row is None or row[0] != 'pending':
+                    missing.append(key)
+                    continue
+                if row[1] is not None and row[1] != reviewer and row[2] > now:
+                    conflicts.append(key)
+                    continue
+                connection.execute(
+                    "UPDATE records SET status = ?, inclusion_importance = ?, exclusion_reason = ?, reviewer = ?, "
+                    "decided_at = ?, lease_holder = NULL, lease_until = NULL WHERE record_id = ?",
+                    (decision["action"], decision.get("inclusion_importance"), decision.get("exclusion_reason"),
+                     reviewer, now, key))
+                record = json.loads(row[3])
+                if decision["action"] == "include":
+                    record["Inclusion_Importance"] = decision.get("inclusion_importance")
+                elif decision["action"] == "exclude":
+                    record["Exclusion_Reason"] = decision.get("exclusion_reason")
+                decided.append(record)
+
+        self.decided_since_compact += len(decided)
+        if self.decided_since_compact >= JOURNAL_COMPACT_EVERY and not self.compact_lock.locked():
+            self.decided_since_compact = 0
+            threading.Thread(target=self.compact, daemon=True).start()
+        return decided, missing, conflicts
+
+    # Same results and order as ReviewStore.search, from the FTS5 tables; decisions only change a record's status,
+    # which is read at query time, so the search tables are only written on import
+    def search(self, query, tables=SEARCH_TABLES, offset=0, limit=20):
+        match = fts_query(query)
+        if match is None:
+            return 0, []
+        connection = self._connection()
+        tables_by_status = {status: table for table, status in TABLE_STATUS.items() if table in tables}
+
+        hits = []
+        if tables_by_status:
+            for record_id, status, position in connection.execute(
+                    "SELECT r.record_id, r.status, r.position FROM records_search s "
+                    "JOIN records r ON r.record_id = s.record_id WHERE records_search MATCH ?", (match,)):
+                if status in tables_by_status:
+                    hits.append((SEARCH_TABLES.index(tables_by_status[status]), position, record_id))
+        if 'duplicates' in tables:
+            for record_id, position in connection.execute(
+                    "SELECT d.record_id, d.position FROM duplicates_search s "
+                    "JOIN duplicates d ON d.record_id = s.record_id WHERE duplicates_search MATCH ?", (match,)):
+                hits.append((SEARCH_TABLES.index('duplicates'), position, record_id))
+        hits.sort()
+
+        results = []
+        for table, _, record_id in hits[offset:offset + limit]:
+            table = SEARCH_TABLES[table]
+            if table == 'duplicates':
+                data, = connection.execute("SELECT data FROM duplicates WHERE record_id = ?", (record_id,)).fetchone()
+                record = json.loads(data)
+            else:
+                data, importance, reason = connection.execute(
+                    "SELECT data, inclusion_importance, exclusion_reason FROM records WHERE record_id = ?",
+                    (record_id,)).fetchone()
+                record = json.loads(data)
+                if table == 'inclusions':
+                    record["Inclusion_Importance"] = importance
+                elif table == 'exclusions':
+                    record["Exclusion_Reason"] = reason
+            results.append((table, record_id, record))
+        return len(hits), results
+
+    def _records_df(self, status, columns_key, decision_field=None, decision_column=None):
+        connection = self._connection()
+        order = "position" if status == 'pending' else "decided_at, position"
+        records = []
+        for data, value in connection.execute(
+                f"SELECT data, {decision_column or 'NULL'} FROM records WHERE status = ? ORDER BY {order}", (status,)):
+            record = json.loads(data)
+            if decision_field is not None:
+                record[decision_field] = value
+            records.append(record)
+        columns = self._meta(connection, columns_key, [])
+        df = pd.DataFrame(records)
+        return df.reindex(columns=columns + [c for c in df.columns if c not in columns])
+
+    def inclusions_df(self):
+        return self._records_df('include', 'inclusions_columns', 'Inclusion_Importance', 'inclusion_importance')
+
+    def exclusions_df(self):
+        return self._records_df('exclude', 'exclusions_columns', 'Exclusion_Reason', 'exclusion_reason')
+
+    def all_data_df(self):
+        return self._records_df('pending', 'columns')
+
+    def duplicates_df(self):
+        connection = self._connection()
+        df = pd.DataFrame([json.loads(data) for data, in
+                           connection.execute("SELECT data FROM duplicates ORDER BY position")])
+        columns = self._meta(connection, 'duplicates_columns', [])
+        return df.reindex(columns=columns + [c for c in df.columns if c not in columns])
+
+    # Writes the database back to the working files, e.g. for the post_ scripts or to share as CSV.
+    # Rows another worker's ingestion appended to the files are imported first, so they are never overwritten.
+    def compact(self):
+        with self.compact_lock, project_lock(self.project), \
+                instrument('review_store_compact', self.project) as measurement:
+            self._import_changed()
+            connection = self._connection()
+            # One read transaction, so the four files are a consistent snapshot
+            connection.execute("BEGIN")
+            try:
+                inclusions_df = self.inclusions_df()
+                exclusions_df = self.exclusions_df()
+                all_data_df = self.all_data_df()
+                duplicates_df = self.duplicates_df()
+            finally:
+                connection.execute("COMMIT")
+
+            save_table(inclusions_df, self.inclusions_file)
+            save_table(exclusions_df, self.exclusions_file)
+            save_table(all_data_df, self.all_data_file)
+            if not duplicates_df.empty:
+                save_table(duplicates_df, self.duplicates_file)
+            measurement['rows'] = len(inclusions_df) + len(exclusions_df) + len(all_data_df)
+
+            with self._transaction() as connection:
+                self._set_meta(connection, 'imported', self._signatures())
+
+    def close(self):
+        self.compact()
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def get_review_store(stores, project):
+    if project not in stores:
+        stores[project] = SqliteReviewStore(project) if REVIEW_STORE == 'sqlite' else ReviewStore(project)
+    return stores[project]
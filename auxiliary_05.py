@@ -0,0 +1,325 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import multiprocessing
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from auxiliary_01 import *
+from auxiliary_03 import *
+from auxiliary_06 import *
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+READY = 'ready'
+FAILED = 'failed'
+
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 1))
+INGEST_CHUNK_ROWS = int(os.environ.get('INGEST_CHUNK_ROWS', 50000))
+
+def rebuild_dedup_index(project, avoid_fields=AVOID_FIELDS):
+    combined_file = get_table_path(project, 'all_data')
+    inclusions_file = get_table_path(project, 'inclusions')
+    exclusions_file = get_table_path(project, 'exclusions')
+    index_file = get_project_path(project, 'dedup_index.csv')
+
+    unique_df = read_table(combined_file)
+    inclusions_df = read_table(inclusions_file)
+    exclusions_df = read_table(exclusions_file)
+
+    with instrument('reconciliation', project, len(unique_df)):
+        is_decided = find_decided(unique_df, [inclusions_df, exclusions_df], avoid_fields)
+    logging.info(f"4 - Found {is_decided.sum()} records in either inclusions or exclusions")
+
+    # Tables written before the key columns existed get them once here
+    if not unique_df.empty and not set(KEY_FIELDS) <= set(unique_df.columns):
+        unique_df = add_key_columns(unique_df)
+        save_table(unique_df[~is_decided], combined_file)
+    elif is_decided.any():
+        save_table(unique_df[~is_decided], combined_file)
+    for decisions_df, decisions_file in ((inclusions_df, inclusions_file), (exclusions_df, exclusions_file)):
+        if not decisions_df.empty and not set(KEY_FIELDS) <= set(decisions_df.columns):
+            save_table(add_key_columns(decisions_df), decisions_file)
+
+    with instrument('dedup_index_rebuild', project) as measurement:
+        index = DedupIndex(avoid_fields)
+        near_index = NearDuplicateIndex()
+        all_keys = []
+        for df in (unique_df[~is_decided], inclusions_df, exclusions_df):
+            keys = index.add_dataframe(df)
+            near_index.add_dataframe(df, keys['fingerprint'])
+            all_keys.append(keys)
+        measurement['rows'] = sum(len(keys) for keys in all_keys)
+
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    append_keys(pd.concat(all_keys, ignore_index=True), index_file)
+    near_index.save(get_project_path(project, 'minhash_index.npz'))
+    return index, near_index
+
+
+def find_and_move_duplicates(project):
+
+    avoid_fields = AVOID_FIELDS
+
+    sources_dir = get_project_path(project, 'sources')
+    duplicates_file = get_table_path(project, 'duplicates')
+    combined_file = get_table_path(project, 'all_data')
+    index_file = get_project_path(project, 'dedup_index.csv')
+    near_index_file = get_project_path(project, 'minhash_index.npz')
+    manifest_file = get_project_path(project, 'ingest_manifest.json')
+    logging.debug(combined_file)
+
+    processed_folder = os.path.join(os.path.dirname(sources_dir), "processed_sources")
+
+    if not os.path.exists(processed_folder):
+        os.makedirs(processed_folder)
+
+    all_files = [os.path.join(sources_dir, f) for f in os.listdir(sources_dir) if f.endswith('.csv')]
+    manifest = load_manifest(manifest_file)
+    appended_files = {'all_data': combined_file, 'duplicates': duplicates_file,
+                      'dedup_index': index_file, 'minhash_index': near_index_file}
+    progress = manifest.get("in_progress")
+    if progress is not None:
+        # A run stopped part way through a source: what it appended after its last committed chunk is dropped
+        logging.info(f"Resuming {progress['name']} after chunk {progress['chunks']}")
+        for name, file_path in appended_files.items():
+            rollback_appends(file_path, progress['checkpoints'][name], progress['appending'].get(name, 0))
+    # Chunks a failed run appended but never merged into the tables
+    compact_table(combined_file)
+    compact_table(duplicates_file)
+
+    new_files = []
+    for file in all_files:
+        digest = file_digest(file)
+        if digest in manifest["files"]:
+            logging.info(f"Skipping {file}, already ingested as {manifest['files'][digest]['name']}")
+        else:
+            new_files.append((file, digest))
+    if progress is not None and progress['digest'] not in [digest for _, digest in new_files]:
+        # Its source was taken away; the chunks it committed stay in the project
+        manifest.pop("in_progress")
+        progress = None
+        save_manifest(manifest, manifest_file)
+    elif progress is not None:
+        new_files.sort(key=lambda item: item[1] != progress['digest'])
+
+    indexes_exist = (os.path.exists(index_file) and os.path.exists(near_index_file)
+                     and manifest.get("keys_version") == KEYS_VERSION)
+    summary = {'files': len(new_files), 'rows': 0, 'added': 0, 'duplicates': 0, 'near_duplicates': 0}
+    if not new_files and indexes_exist:
+        logging.info("No new sources to ingest")
+    else:
+        if indexes_exist:
+            with instrument('dedup_index_load', project):
+                index = DedupIndex.load(index_file, avoid_fields)
+                near_index = NearDuplicateIndex.load(near_index_file)
+        else:
+            index, near_index = rebuild_dedup_index(project, avoid_fields)
+            manifest["keys_version"] = KEYS_VERSION
+            save_manifest(manifest, manifest_file)
+
+        # Compaction and index rebuilds above moved what the checkpoints of a resumed source point at
+        if progress is not None:
+            progress['checkpoints'] = {name: append_checkpoint(path) for name, path in appended_files.items()}
+            save_manifest(manifest, manifest_file)
+
+        added = duplicated = near_duplicated = 0
+        for file, digest in new_files:
+            profile = detect_profile(read_csv_header(file))
+            logging.info(f"Reading {file} with the {profile or 'generic'} field profile")
+            if progress is None or progress['digest'] != digest:
+                progress = {'digest': digest, 'name': os.path.basename(file), 'chunks': 0, 'rows': 0, 'added': 0,
+                            'duplicates': 0, 'near_duplicates': 0, 'appending': {},
+                            'checkpoints': {name: append_checkpoint(path) for name, path in appended_files.items()}}
+            # Everything is read as text and typed by normalise_source, so types are the same in every chunk
+            for number, chunk in enumerate(read_csv_chunks(file, INGEST_CHUNK_ROWS, str)):
+                if number < progress['chunks']:
+                    continue
+                with instrument('dedup', project, len(chunk)):
+                    chunk = add_key_columns(normalise_source(chunk, profile))
+                    keys = record_keys(chunk, avoid_fields)
+                    is_duplicate = index.mark_duplicates(keys)
+                    near_matches = near_index.mark_near_duplicates(chunk, keys['fingerprint'], ~is_duplicate)
+                    is_near_duplicate = near_matches['Duplicate_Of'].notna()
+                    is_unique = ~is_duplicate & ~is_near_duplicate
+
+                duplicates = chunk[~is_unique].join(near_matches[is_near_duplicate]) if is_near_duplicate.any() \
+                    else chunk[~is_unique]
+                # The rows about to be appended are noted first, so a CSV rewritten for new columns can be rolled back
+                progress['appending'] = {'all_data': int(is_unique.sum()), 'duplicates': len(duplicates)}
+                manifest["in_progress"] = progress
+                save_manifest(manifest, manifest_file)
+
+                append_table(chunk[is_unique], combined_file)
+                append_table(duplicates, duplicates_file)
+                append_keys(keys[~is_duplicate], index_file)
+                near_index.save_part(near_index_file)
+
+                # The chunk is committed once the manifest has its checkpoints
+                progress.update(chunks=number + 1, rows=progress['rows'] + len(chunk),
+                                added=progress['added'] + int(is_unique.sum()),
+                                duplicates=progress['duplicates'] + int(is_duplicate.sum()),
+                                near_duplicates=progress['near_duplicates'] + int(is_near_duplicate.sum()),
+                                appending={},
+                                checkpoints={name: append_checkpoint(path) for name, path in appended_files.items()})
+                save_manifest(manifest, manifest_file)
+
+            summary['rows'] += progress['rows']
+            added += progress['added']
+            duplicated += progress['duplicates']
+            near_duplicated += progress['near_duplicates']
+            add_to_manifest(manifest, file, digest, progress['rows'], profile)
+            manifest.pop("in_progress", None)
+            progress = None
+            near_index.save(near_index_file)
+            save_manifest(manifest, manifest_file)
+
+        compact_table(combined_file)
+        compact_table(duplicates_file)
+
+        if new_files:
+            logging.info(f"3 - Saving Duplicates containing {duplicated} new records and {near_duplicated} near-duplicates")
+            logging.info(f"5 - Added {added} new unique records")
+            summary.update(added=int(added), duplicates=int(duplicated), near_duplicates=int(near_duplicated))
+
+    for file in all_files:
+        destination = os.path.join(processed_folder, os.path.basename(file))
+        if os.path.exists(destination):
+            # A later export with the same name as an earlier one keeps both
+            name, extension = os.path.splitext(os.path.basename(file))
+            destination = os.path.join(processed_folder, f"{name}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}{extension}")
+        shutil.move(file, destination)
+        logging.info(f"Moved {file} to {processed_folder}")
+
+    return summary
+
+
+def save_run_report(report, report_file):
+    tmp_path = f"{report_file}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_path, report_file)
+
+
+# Adds the stages the app ran after ingestion, e.g. loading the review store, to the project's last run report
+def extend_run_report(report_file, stages):
+    if not stages or report_file is None or not os.path.exists(report_file):
+        return
+    with open(report_file, encoding='utf-8') as file:
+        report = json.load(file)
+    report['stages'] += stages
+    save_run_report(report, report_file)
+
+
+# Entry point for the worker processes; the log goes to the project's ingest.log and the time, rows and
+# memory of every stage to its run_report.json
+def run_ingestion(project):
+    log_file = get_project_path(project, 'ingest.log')
+    report_file = get_project_path(project, 'run_report.json')
+    report = {'project': project, 'started': datetime.now().isoformat(timespec='seconds'), 'state': FAILED}
+    started = time.perf_counter()
+
+    handler = logging.FileHandler(log_file, encoding='utf-8')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    handlers, root.handlers = root.handlers, [handler]
+    try:
+        logging.info(f"=== ingesting {project}")
+        with collecting() as stages:
+            try:
+                # App workers started together each ingest the project; they take turns and the later ones find nothing new
+                with project_lock(project), instrument('ingest', project) as measurement:
+                    report['summary'] = find_and_move_duplicates(project)
+                    measurement['rows'] = report['summary']['rows']
+                report['state'] = READY
+            except Exception as e:
+                logging.exception(f"Ingestion of {project} failed")
+                report['error'] = str(e)
+                raise
+            finally:
+                seconds = time.perf_counter() - started
+                report.update(finished=datetime.now().isoformat(timespec='seconds'), seconds=seconds,
+                              peak_rss_bytes=peak_rss(), stages=stages)
+                save_run_report(report, report_file)
+        logging.info(f"=== finished in {seconds:.2f}s")
+    finally:
+        root.handlers = handlers
+        handler.close()
+
+    return {'seconds': seconds, 'log': log_file, 'report': report_file, 'stages': stages}
+
+
+# Runs project ingestion off the request path, one worker process per project, and keeps a per-project status
+class IngestionWorker:
+
+    def __init__(self, max_workers=INGEST_WORKERS):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.processes = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.lock = threading.Lock()
+        self.status = {}
+
+    def _set_status(self, project, **status):
+        with self.lock:
+            self.status.setdefault(project, {}).update(status)
+
+    def submit(self, project, task=run_ingestion, on_ready=None):
+        self._set_status(project, state=QUEUED, error=None, started=None, finished=None, seconds=None, log=None,
+                         report=None)
+        return self.executor.submit(self._run, project, task, on_ready)
+
+    def _run(self, project, task, on_ready):
+        self._set_status(project, state=PROCESSING, started=time.time())
+        try:
+            result = self.processes.submit(task, project).result()
+            # The stages ran in the worker process, so they are added to this process's metrics here
+            for measurement in result.pop('stages', []):
+                metrics.record_stage(measurement)
+            if on_ready is not None:
+                with collecting() as stages:
+                    on_ready(project)
+                extend_run_report(result.get('report'), stages)
+        except Exception as e:
+            logging.exception(f"Ingestion failed for project {project}")
+            self._set_status(project, state=FAILED, error=str(e), finished=time.time(),
+                             log=get_project_path(project, 'ingest.log'),
+                             report=get_project_path(project, 'run_report.json'))
+        else:
+            self._set_status(project, state=READY, finished=time.time(), **result)
+            logging.info(f"Ingested project {project} in {result['seconds']:.2f}s, log: {result['log']}")
+
+    # Projects that were never submitted are served straight from disk
+    def state(self, project):
+        with self.lock:
+            return self.status.get(project, {}).get('state', READY)
+
+    def get_status(self, project=None):
+        with self.lock:
+            if project is not None:
+                return dict(self.status.get(project, {'state': READY}))
+            return {name: dict(status) for name, status in self.status.items()}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.processes.shutdown(wait=True)
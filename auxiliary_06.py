@@ -0,0 +1,124 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pandas as pd
+
+# Canonical record layout shared by every source; names follow the Scopus export
+CANONICAL_FIELDS = [
+    'Authors', 'Title', 'Year', 'Source title', 'Volume', 'Issue', 'Page start', 'Page end', 'Cited by', 'DOI',
+    'Link', 'Affiliations', 'Abstract', 'Author Keywords', 'Index Keywords', 'Publisher', 'ISSN', 'ISBN',
+    'Language of Original Document', 'Document Type', 'Source', 'EID', 'arXiv ID'
+]
+INTEGER_FIELDS = ['Year', 'Cited by']
+CATEGORY_FIELDS = ['Source', 'Publisher', 'Document Type', 'Language of Original Document']
+
+# Each profile is recognised by the headers in 'detect' and maps its own column names onto CANONICAL_FIELDS
+SOURCE_PROFILES = {
+    'scopus': {
+        'detect': ['EID', 'Source title'],
+        'source': 'Scopus',
+        'fields': {field: field for field in CANONICAL_FIELDS},
+    },
+    'ieee': {
+        'detect': ['Document Title', 'Publication Title'],
+        'source': 'IEEE Xplore',
+        'fields': {
+            'Authors': 'Authors', 'Document Title': 'Title', 'Publication Year': 'Year',
+            'Publication Title': 'Source title', 'Volume': 'Volume', 'Issue': 'Issue', 'Start Page': 'Page start',
+            'End Page': 'Page end', 'Article Citation Count': 'Cited by', 'DOI': 'DOI', 'PDF Link': 'Link',
+            'Author Affiliations': 'Affiliations', 'Abstract': 'Abstract', 'Author Keywords': 'Author Keywords',
+            'IEEE Terms': 'Index Keywords', 'Publisher': 'Publisher', 'ISSN': 'ISSN', 'ISBNs': 'ISBN',
+            'Document Identifier': 'Document Type',
+        },
+    },
+    'wos': {
+        'detect': ['UT (Unique WOS ID)'],
+        'source': 'Web of Science',
+        'fields': {
+            'Authors': 'Authors', 'Article Title': 'Title', 'Publication Year': 'Year',
+            'Source Title': 'Source title', 'Volume': 'Volume', 'Issue': 'Issue', 'Start Page': 'Page start',
+            'End Page': 'Page end', 'Times Cited, All Databases': 'Cited by', 'DOI': 'DOI',
+            'Addresses': 'Affiliations', 'Abstract': 'Abstract', 'Author Keywords': 'Author Keywords',
+            'Keywords Plus': 'Index Keywords', 'Publisher': 'Publisher', 'ISSN': 'ISSN', 'ISBN': 'ISBN',
+            'Language': 'Language of Original Document', 'Document Type': 'Document Type',
+        },
+    },
+    'wos_tags': {
+        'detect': ['UT', 'TI', 'AU'],
+        'source': 'Web of Science',
+        'fields': {
+            'AU': 'Authors', 'TI': 'Title', 'PY': 'Year', 'SO': 'Source title', 'VL': 'Volume', 'IS': 'Issue',
+            'BP': 'Page start', 'EP': 'Page end', 'Z9': 'Cited by', 'DI': 'DOI', 'C1': 'Affiliations',
+            'AB': 'Abstract', 'DE': 'Author Keywords', 'ID': 'Index Keywords', 'PU': 'Publisher', 'SN': 'ISSN',
+            'BN': 'ISBN', 'LA': 'Language of Original Document', 'DT': 'Document Type',
+        },
+    },
+    'arxiv': {
+        'detect': ['Published Date', 'Link'],
+        'source': 'arXiv',
+        'fields': {
+            'Title': 'Title', 'Authors': 'Authors', 'Published Date': 'Year', 'Abstract': 'Abstract', 'Link': 'Link',
+            'DOI': 'DOI', 'arXiv ID': 'arXiv ID',
+        },
+    },
+}
+
+
+def detect_profile(columns):
+    columns = set(columns)
+    for name, profile in SOURCE_PROFILES.items():
+        if all(field in columns for field in profile['detect']):
+            return name
+    return None
+
+
+# Projects a source frame onto CANONICAL_FIELDS with compact column types.
+# Files from unknown sources keep the columns that already have canonical names, or pass through untouched.
+def normalise_source(df, profile_name):
+    if profile_name is None:
+        fields = {field: field for field in CANONICAL_FIELDS if field in df.columns}
+        if not fields:
+            return df
+        source = None
+    else:
+        profile = SOURCE_PROFILES[profile_name]
+        fields = {column: field for column, field in profile['fields'].items() if column in df.columns}
+        source = profile['source']
+
+    normalised = pd.DataFrame(index=df.index)
+    for field in CANONICAL_FIELDS:
+        column = next((column for column, target in fields.items() if target == field), None)
+        if column is not None:
+            normalised[field] = df[column]
+
+    if source is not None and ('Source' not in normalised.columns or normalised['Source'].isna().all()):
+        normalised['Source'] = source
+    if 'Year' in normalised.columns:
+        # arXiv gives a full timestamp; every other source gives the year alone
+        normalised['Year'] = normalised['Year'].astype(str).str[:4]
+
+    for field in normalised.columns:
+        if field in INTEGER_FIELDS:
+            normalised[field] = pd.to_numeric(normalised[field], errors='coerce').astype('Int64')
+        elif field in CATEGORY_FIELDS:
+            normalised[field] = normalised[field].astype('category')
+        else:
+            normalised[field] = normalised[field].where(normalised[field].notna(), None).astype(object)
+
+    return normalised.reindex(columns=[field for field in CANONICAL_FIELDS if field in normalised.columns])
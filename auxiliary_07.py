@@ -0,0 +1,93 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from collections import defaultdict
+import pandas as pd
+from auxiliary_03 import normalise_text
+
+SEARCH_FIELDS = ['Title', 'Document Title', 'Abstract', 'Author Keywords']
+SEARCH_TABLES = ['all_data', 'inclusions', 'exclusions', 'duplicates']
+# What a search result shows of a record
+RESULT_FIELDS = ['Title', 'Authors', 'Year', 'Source title', 'DOI', 'Inclusion_Importance', 'Exclusion_Reason',
+                 'Duplicate_Of']
+TABLE_STATUS = {'all_data': 'pending', 'inclusions': 'include', 'exclusions': 'exclude'}
+
+
+# The searchable text of a record, normalised the same way as the duplicate-detection keys
+def search_text(record):
+    return normalise_text(' '.join(value for value in (record.get(field) for field in SEARCH_FIELDS)
+                                   if isinstance(value, str)))
+
+
+# Words must all appear in the record; "quoted words" must appear next to each other
+def parse_query(query):
+    phrases = [normalise_text(phrase) for phrase in re.findall(r'"([^"]*)"', query)]
+    phrases = [phrase for phrase in phrases if phrase]
+    words = normalise_text(re.sub(r'"[^"]*"', ' ', query)).split()
+    terms = list(dict.fromkeys(words + [word for phrase in phrases for word in phrase.split()]))
+    return terms, phrases
+
+
+def result_record(record):
+    return {field: record[field] for field in RESULT_FIELDS if field in record and pd.notna(record[field])}
+
+
+# In-process inverted index from words to documents, each in one of SEARCH_TABLES.
+# A decision only moves its document to another table, so the postings never need rebuilding.
+class SearchIndex:
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.docs = {}
+
+    def add(self, doc, table, position, record):
+        text = search_text(record)
+        self.docs[doc] = [table, position, record, text]
+        for word in set(text.split()):
+            self.postings[word].add(doc)
+
+    def move(self, doc, table, record):
+        if doc in self.docs:
+            self.docs[doc][0] = table
+            self.docs[doc][2] = record
+
+    def search(self, query, tables=SEARCH_TABLES, offset=0, limit=20):
+        terms, phrases = parse_query(query)
+        if not terms:
+            return 0, []
+
+        postings = sorted((self.postings.get(term, set()) for term in terms), key=len)
+        matches = set(postings[0]).intersection(*postings[1:])
+        hits = []
+        for doc in matches:
+            table, position, record, text = self.docs[doc]
+            if table in tables and all(f" {phrase} " in f" {text} " for phrase in phrases):
+                hits.append((SEARCH_TABLES.index(table), position, doc))
+        hits.sort()
+
+        return len(hits), [(SEARCH_TABLES[table], doc, self.docs[doc][2]) for table, _, doc in hits[offset:offset + limit]]
+
+
+# FTS5 query equivalent to parse_query: every word and every phrase, quoted so nothing is read as an operator
+def fts_query(query):
+    terms, phrases = parse_query(query)
+    if not terms:
+        return None
+    return ' AND '.join(f'"{part}"' for part in terms + phrases)
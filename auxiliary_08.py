@@ -0,0 +1,210 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+# tracemalloc slows every allocation down, so memory snapshots are only taken when asked for
+METRICS_TRACEMALLOC = os.environ.get('METRICS_TRACEMALLOC', '0') == '1'
+METRICS_TRACEMALLOC_TOP = int(os.environ.get('METRICS_TRACEMALLOC_TOP', 10))
+METRICS_PREFIX = 'multimetafilter'
+# Upper bounds, in seconds, of the HTTP request duration histogram
+HTTP_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+if METRICS_TRACEMALLOC and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+_local = threading.local()
+
+
+# Peak resident set size of this process in bytes, None where getrusage is not available (Windows)
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_label(value)}"' for name, value in labels.items()) + '}'
+
+
+# Totals of every instrumented stage and HTTP route of this process, rendered in the Prometheus text format
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.requests = {}
+        self.durations = {}
+
+    def record_stage(self, measurement):
+        key = (measurement['stage'], measurement['project'] or '')
+        with self.lock:
+            totals = self.stages.setdefault(key, {'count': 0, 'seconds': 0.0, 'rows': 0, 'max_seconds': 0.0,
+                                                  'peak_rss_bytes': None, 'traced_peak_bytes': None})
+            totals['count'] += 1
+            totals['seconds'] += measurement['seconds']
+            totals['rows'] += measurement['rows'] or 0
+            totals['max_seconds'] = max(totals['max_seconds'], measurement['seconds'])
+            for field in ('peak_rss_bytes', 'traced_peak_bytes'):
+                if measurement.get(field) is not None:
+                    totals[field] = measurement[field]
+
+    def record_request(self, method, route, status, seconds):
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.setdefault((method, route), {'buckets': [0] * len(HTTP_BUCKETS),
+                                                                    'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(HTTP_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    # gauges: [(name, help, [(labels, value), ...]), ...] measured by the caller at scrape time
+    def render(self, gauges=()):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{METRICS_PREFIX}_{name}{suffix}{_labels(**labels)} {value}")
+
+        with self.lock:
+            stages = [(dict(stage=stage, project=project), totals) for (stage, project), totals in sorted(self.stages.items())]
+            requests = sorted(self.requests.items())
+            durations = sorted((key, dict(histogram, buckets=list(histogram['buckets'])))
+                               for key, histogram in self.durations.items())
+
+        family('stage_runs_total', 'counter', 'Times each stage ran.',
+               [('', labels, totals['count']) for labels, totals in stages])
+        family('stage_seconds_total', 'counter', 'Wall time spent in each stage.',
+               [('', labels, f"{totals['seconds']:.6f}") for labels, totals in stages])
+        family('stage_rows_total', 'counter', 'Rows processed by each stage.',
+               [('', labels, totals['rows']) for labels, totals in stages])
+        family('stage_max_seconds', 'gauge', 'Longest single run of each stage.',
+               [('', labels, f"{totals['max_seconds']:.6f}") for labels, totals in stages])
+        family('stage_peak_rss_bytes', 'gauge', 'Peak resident set size of the process at the end of the last run.',
+               [('', labels, totals['peak_rss_bytes']) for labels, totals in stages
+                if totals['peak_rss_bytes'] is not None])
+        family('stage_traced_peak_bytes', 'gauge', 'Rise of memory traced by tracemalloc during the last run.',
+               [('', labels, totals['traced_peak_bytes']) for labels, totals in stages
+                if totals['traced_peak_bytes'] is not None])
+
+        family('http_requests_total', 'counter', 'HTTP requests by route and status.',
+               [('', dict(method=method, route=route, status=status), count)
+                for (method, route, status), count in requests])
+        samples = []
+        for (method, route), histogram in durations:
+            for bound, count in zip(HTTP_BUCKETS, histogram['buckets']):
+                samples.append(('_bucket', dict(method=method, route=route, le=bound), count))
+            samples.append(('_bucket', dict(method=method, route=route, le='+Inf'), histogram['count']))
+            samples.append(('_sum', dict(method=method, route=route), f"{histogram['sum']:.6f}"))
+            samples.append(('_count', dict(method=method, route=route), histogram['count']))
+        family('http_request_duration_seconds', 'histogram', 'HTTP request duration by route.', samples)
+
+        rss = peak_rss()
+        if rss is not None:
+            family('process_peak_rss_bytes', 'gauge', 'Peak resident set size of this process.', [('', {}, rss)])
+        for name, help, samples in gauges:
+            family(name, 'gauge', help, [('', labels, value) for labels, value in samples])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# Times a stage of work; the caller sets measurement['rows'] when it knows how many rows the stage handled.
+# With METRICS_TRACEMALLOC=1 it also measures how far traced memory rose above where it was when the stage
+# started, nested stages included, and the outermost stage of a thread keeps the lines whose allocations grew most.
+@contextmanager
+def instrument(stage, project=None, rows=None):
+    measurement = {'stage': stage, 'project': project, 'rows': rows,
+                   'started': datetime.now().isoformat(timespec='milliseconds')}
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        stack = _local.__dict__.setdefault('traced', [])
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        frame = {'peak': 0, 'start': tracemalloc.get_traced_memory()[0],
+                 'snapshot': None if stack else tracemalloc.take_snapshot()}
+        stack.append(frame)
+    started = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement['seconds'] = time.perf_counter() - started
+        if measurement['rows'] is not None and measurement['seconds'] > 0:
+            measurement['rows_per_second'] = measurement['rows'] / measurement['seconds']
+        measurement['peak_rss_bytes'] = peak_rss()
+        if tracing:
+            stack.pop()
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            measurement['traced_peak_bytes'] = max(0, peak - frame['start'])
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            else:
+                statistics = tracemalloc.take_snapshot().compare_to(frame['snapshot'], 'lineno')
+                measurement['top_allocations'] = [{'line': str(statistic.traceback), 'bytes': statistic.size_diff,
+                                                   'blocks': statistic.count_diff}
+                                                  for statistic in statistics[:METRICS_TRACEMALLOC_TOP]]
+            tracemalloc.reset_peak()
+
+        metrics.record_stage(measurement)
+        collected = getattr(_local, 'collected', None)
+        if collected is not None:
+            collected.append(measurement)
+        rows = '' if measurement['rows'] is None else f", {measurement['rows']} rows"
+        logging.debug(f"{stage} {project or ''}: {measurement['seconds']:.3f}s{rows}")
+
+
+# Gathers the measurements of every stage the current thread runs inside the block, e.g. for a run report
+@contextmanager
+def collecting():
+    previous = getattr(_local, 'collected', None)
+    _local.collected = []
+    try:
+        yield _local.collected
+    finally:
+        if previous is not None:
+            previous.extend(_local.collected)
+        _local.collected = previous
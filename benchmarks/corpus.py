@@ -0,0 +1,242 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Synthetic Scopus, IEEE Xplore and arXiv exports of one body of papers, with a known share of duplicates.
+# Usage: python -m benchmarks.corpus <sources_dir> <records> [duplicate_rate] [seed]
+
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Share of the records exported by each database
+SOURCE_SHARES = {'scopus': 0.5, 'ieee': 0.3, 'arxiv': 0.2}
+# How a duplicate differs from the paper it copies: 'exact' only in the export layout, 'doi' in the way the DOI
+# is written, 'near' in a lost DOI, a reworded title and a few changed words of the abstract
+DUPLICATE_VARIANTS = {'exact': 0.5, 'doi': 0.25, 'near': 0.25}
+
+DOMAIN_WORDS = [
+    'artificial', 'intelligence', 'machine', 'learning', 'criminal', 'justice', 'policing', 'predictive', 'court',
+    'sentencing', 'algorithm', 'algorithmic', 'bias', 'fairness', 'risk', 'assessment', 'recidivism', 'facial',
+    'recognition', 'surveillance', 'privacy', 'ethics', 'governance', 'accountability', 'transparency', 'data',
+    'model', 'neural', 'network', 'analysis', 'system', 'law', 'enforcement', 'public', 'safety', 'evidence',
+    'decision', 'support', 'automated', 'framework', 'policy', 'regulation', 'oversight', 'england', 'wales',
+    'united', 'kingdom', 'police', 'judicial', 'legal', 'offender', 'crime', 'prediction', 'classification',
+]
+SYLLABLES = ['ka', 'ro', 'mi', 'ten', 'sa', 'lu', 'vor', 'de', 'pi', 'gan', 'tho', 'rel', 'ux', 'bin', 'ca', 'fe']
+SURNAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Wright',
+            'Robinson', 'Thompson', 'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson',
+            'Clarke', 'Khan', 'Lopes', 'Silva', 'Costa', 'Martin', 'Chen', 'Wang', 'Li', 'Zhang', 'Kumar', 'Singh']
+PUBLISHERS = ['Elsevier', 'Springer', 'IEEE', 'Wiley', 'Taylor and Francis', 'SAGE', 'Oxford University Press']
+DOCUMENT_TYPES = ['Article', 'Conference Paper', 'Review', 'Book Chapter']
+
+SCOPUS_COLUMNS = ['Authors', 'Title', 'Year', 'Source title', 'Volume', 'Issue', 'Page start', 'Page end', 'Cited by',
+                  'DOI', 'Link', 'Affiliations', 'Abstract', 'Author Keywords', 'Index Keywords', 'Publisher', 'ISSN',
+                  'ISBN', 'Language of Original Document', 'Document Type', 'Source', 'EID']
+IEEE_COLUMNS = {'Document Title': 'Title', 'Authors': 'Authors', 'Author Affiliations': 'Affiliations',
+                'Publication Title': 'Source title', 'Publication Year': 'Year', 'Volume': 'Volume', 'Issue': 'Issue',
+                'Start Page': 'Page start', 'End Page': 'Page end', 'Abstract': 'Abstract', 'ISSN': 'ISSN',
+                'ISBNs': 'ISBN', 'DOI': 'DOI', 'PDF Link': 'Link', 'Author Keywords': 'Author Keywords',
+                'IEEE Terms': 'Index Keywords', 'Article Citation Count': 'Cited by', 'Publisher': 'Publisher',
+                'Document Identifier': 'Document Type'}
+ARXIV_COLUMNS = ['Title', 'Authors', 'Published Date', 'Abstract', 'Link', 'DOI', 'arXiv ID']
+
+
+# Domain words plus made-up ones, drawn with Zipf-like frequencies as in real abstracts
+def vocabulary(rng, size=4000):
+    words = list(DOMAIN_WORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES, rng.integers(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    words = np.array(words)
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    return words, weights / weights.sum()
+
+
+def _texts(rng, words, weights, count, low, high):
+    lengths = rng.integers(low, high + 1, count)
+    drawn = rng.choice(words, lengths.sum(), p=weights).tolist()
+    ends = np.cumsum(lengths).tolist()
+    return [' '.join(drawn[end - length:end]) for end, length in zip(ends, lengths.tolist())]
+
+
+def generate_papers(rng, count):
+    words, weights = vocabulary(rng)
+    titles = [title.capitalize() for title in _texts(rng, words, weights, count, 6, 14)]
+    abstracts = [abstract.capitalize() + '.' for abstract in _texts(rng, words, weights, count, 120, 250)]
+    keywords = ['; '.join(keywords.split()) for keywords in _texts(rng, words, weights, count, 3, 6)]
+    index_keywords = ['; '.join(keywords.split()) for keywords in _texts(rng, words, weights, count, 4, 8)]
+    journals = [f"Journal of {' '.join(journal.split()).title()}" for journal in _texts(rng, words, weights, 200, 2, 4)]
+
+    lengths = rng.integers(1, 7, count)
+    names = [f"{name} {initial}." for name, initial in zip(rng.choice(SURNAMES, lengths.sum()).tolist(),
+                                                          rng.choice(list('ABCDEFGHJKLMNPRSTW'), lengths.sum()).tolist())]
+    ends = np.cumsum(lengths).tolist()
+    authors = [', '.join(names[end - length:end]) for end, length in zip(ends, lengths.tolist())]
+
+    page_start = rng.integers(1, 900, count)
+    has_doi = rng.random(count) < 0.85
+    return pd.DataFrame({
+        'Title': titles,
+        'Authors': authors,
+        'Year': rng.integers(1995, 2025, count),
+        'Month': rng.integers(1, 13, count),
+        'Source title': rng.choice(journals, count),
+        'Volume': rng.integers(1, 60, count),
+        'Issue': rng.integers(1, 12, count),
+        'Page start': page_start,
+        'Page end': page_start + rng.integers(5, 30, count),
+        'Cited by': rng.poisson(8, count),
+        'DOI': [f"10.{prefix}/bench.{paper}" if doi else None
+                for paper, (prefix, doi) in enumerate(zip(rng.integers(1000, 9999, count), has_doi))],
+        'Affiliations': rng.choice(['University of Oxford', 'University of Leeds', "King's College London",
+                                    'University of Manchester', 'University College London'], count),
+        'Abstract': np.where(rng.random(count) < 0.03, '[No abstract available]', abstracts),
+        'Author Keywords': keywords,
+        'Index Keywords': index_keywords,
+        'Publisher': rng.choice(PUBLISHERS, count),
+        'ISSN': [f"{a:04d}-{b:04d}" for a, b in zip(rng.integers(0, 9999, count), rng.integers(0, 9999, count))],
+        'Language of Original Document': 'English',
+        'Document Type': rng.choice(DOCUMENT_TYPES, count, p=[0.6, 0.3, 0.07, 0.03]),
+    })
+
+
+def _vary_doi(doi, rng):
+    form = rng.integers(3)
+    if form == 0:
+        return doi.upper()
+    if form == 1:
+        return f"https://doi.org/{doi}"
+    return f"doi:{doi}"
+
+
+def _reword(text, rng, words, changes):
+    tokens = text.split()
+    for position in rng.integers(0, len(tokens), changes):
+        tokens[position] = rng.choice(words)
+    return ' '.join(tokens)
+
+
+# Turns a paper into a copy that the duplicate detection should still catch
+def make_duplicate(paper, variant, rng, words):
+    paper = dict(paper)
+    if variant == 'doi' and paper['DOI']:
+        paper['DOI'] = _vary_doi(paper['DOI'], rng)
+    elif variant == 'near':
+        paper['DOI'] = None
+        paper['Title'] = paper['Title'].upper() + '.'
+        if paper['Abstract'] != '[No abstract available]':
+            paper['Abstract'] = _reword(paper['Abstract'], rng, words, 2)
+    return paper
+
+
+def scopus_export(papers, rng):
+    df = papers.copy()
+    df['Link'] = [f"https://www.scopus.com/record/{eid}" for eid in rng.integers(10 ** 9, 10 ** 10, len(df))]
+    df['ISBN'] = None
+    df['Source'] = 'Scopus'
+    df['EID'] = [f"2-s2.0-{eid}" for eid in rng.integers(10 ** 10, 10 ** 11, len(df))]
+    return df[SCOPUS_COLUMNS]
+
+
+def ieee_export(papers, rng):
+    df = papers.copy()
+    df['Link'] = [f"https://ieeexplore.ieee.org/stamp/stamp.jsp?arnumber={n}" for n in rng.integers(10 ** 6, 10 ** 7, len(df))]
+    df['ISBN'] = None
+    df['Authors'] = df['Authors'].str.replace(', ', '; ', regex=False)
+    df['Document Type'] = df['Document Type'].map({'Article': 'IEEE Journals', 'Conference Paper': 'IEEE Conferences'}).fillna('IEEE Early Access')
+    return df.rename(columns={field: column for column, field in IEEE_COLUMNS.items()})[list(IEEE_COLUMNS)]
+
+
+def arxiv_export(papers, rng):
+    ids = [f"{year % 100:02d}{month:02d}.{n:05d}" for year, month, n in
+           zip(papers['Year'], papers['Month'], rng.integers(0, 99999, len(papers)))]
+    return pd.DataFrame({
+        'Title': papers['Title'].values,
+        'Authors': papers['Authors'].values,
+        'Published Date': [f"{year}-{month:02d}-01T00:00:00Z" for year, month in zip(papers['Year'], papers['Month'])],
+        'Abstract': papers['Abstract'].values,
+        'Link': [f"http://arxiv.org/pdf/{arxiv_id}v1" for arxiv_id in ids],
+        # Preprints mostly have no DOI yet
+        'DOI': np.where(rng.random(len(papers)) < 0.4, papers['DOI'].values, None),
+        'arXiv ID': ids,
+    })
+
+
+EXPORTS = {'scopus': scopus_export, 'ieee': ieee_export, 'arxiv': arxiv_export}
+
+
+# Writes one CSV per database holding records in total, of which duplicate_rate are extra copies of papers
+# already exported by some database. Returns what was generated, for judging the duplicate detection.
+def generate_corpus(sources_dir, records, duplicate_rate=0.3, seed=23):
+    rng = np.random.default_rng(seed)
+    os.makedirs(sources_dir, exist_ok=True)
+
+    duplicates = int(round(records * duplicate_rate))
+    papers = generate_papers(rng, records - duplicates)
+    words, _ = vocabulary(np.random.default_rng(seed))
+    sources = list(SOURCE_SHARES)
+    shares = list(SOURCE_SHARES.values())
+
+    paper_records = papers.to_dict('records')
+    rows = {source: [] for source in sources}
+    for paper, source in zip(paper_records, rng.choice(sources, len(papers), p=shares)):
+        rows[source].append(paper)
+
+    variants = {variant: 0 for variant in DUPLICATE_VARIANTS}
+    originals = rng.integers(0, len(papers), duplicates)
+    for original, source, variant in zip(originals, rng.choice(sources, duplicates, p=shares),
+                                         rng.choice(list(DUPLICATE_VARIANTS), duplicates,
+                                                    p=list(DUPLICATE_VARIANTS.values()))):
+        rows[source].append(make_duplicate(paper_records[original], variant, rng, words))
+        variants[variant] += 1
+
+    files = {}
+    for source in sources:
+        if not rows[source]:
+            continue
+        df = pd.DataFrame(rows[source]).sample(frac=1, random_state=int(rng.integers(2 ** 31)))
+        file_path = os.path.join(sources_dir, f"{source}-{records}.csv")
+        EXPORTS[source](df.reset_index(drop=True), rng).to_csv(file_path, index=False)
+        files[os.path.basename(file_path)] = len(df)
+
+    return {
+        "records": records,
+        "papers": len(papers),
+        "duplicates": duplicates,
+        "duplicate_rate": duplicate_rate,
+        "duplicate_variants": variants,
+        "seed": seed,
+        "files": files,
+    }
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if len(arguments) < 2:
+        print("Usage: python -m benchmarks.corpus <sources_dir> <records> [duplicate_rate] [seed]")
+        sys.exit(1)
+    summary = generate_corpus(arguments[0], int(arguments[1]),
+                              float(arguments[2]) if len(arguments) > 2 else 0.3,
+                              int(arguments[3]) if len(arguments) > 3 else 23)
+    print(json.dumps(summary, indent=4))
@@ -0,0 +1,312 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Times ingestion, duplicate detection, reconciliation with earlier decisions, screening decisions through the
+# web app and the Venn/UpSet data on synthetic corpora of several sizes, and writes the timings as JSON.
+# Usage: python -m benchmarks.run [--sizes 1000,10000,100000] [--duplicate-rate 0.3] [--decisions 200]
+#                                  [--workspace DIR] [--output FILE] [--compare EARLIER_RESULTS.json]
+
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+import numpy as np
+from benchmarks.corpus import generate_corpus
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [1000, 10000, 100000]
+# Share of the unique records given a decision before reconciliation is timed
+DECIDED_SHARE = 0.2
+DECISION_BATCH = 10
+
+
+def project_name(records):
+    return f"bench-{records}"
+
+
+# The app works on the projects folder of the current directory, so every run gets a directory of its own
+def prepare_workspace(workspace, sizes, duplicate_rate, seed):
+    corpora = {}
+    for records in sizes:
+        project_dir = os.path.join(workspace, 'projects', project_name(records))
+        shutil.rmtree(project_dir, ignore_errors=True)
+        corpora[records] = generate_corpus(os.path.join(project_dir, 'sources'), records, duplicate_rate, seed)
+    for folder in ('static', 'templates'):
+        if not os.path.exists(os.path.join(workspace, folder)):
+            shutil.copytree(os.path.join(REPO_DIR, folder), os.path.join(workspace, folder))
+    return corpora
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def stage(seconds, rows, **extra):
+    return {"seconds": round(seconds, 4), "rows": int(rows),
+            "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None, **extra}
+
+
+def latency_summary(latencies):
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 3),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 3),
+        "max_ms": round(float(milliseconds.max()), 3),
+    }
+
+
+# Ingestion with duplicate detection, on the corpus as it comes out of the databases
+def bench_ingest(project, corpus):
+    from auxiliary_01 import get_table_path, count_rows
+    from auxiliary_05 import find_and_move_duplicates
+
+    _, seconds = timed(find_and_move_duplicates, project)
+    unique = count_rows(get_table_path(project, 'all_data'))
+    return stage(seconds, corpus['records'], unique_records=unique,
+                 duplicates_found=count_rows(get_table_path(project, 'duplicates')),
+                 duplicates_injected=corpus['duplicates'],
+                 # Copies that slipped through show up as unique records beyond the number of papers
+                 duplicates_missed=max(0, unique - corpus['papers']))
+
+
+# Gives a share of the records a decision, the way screening leaves a project
+def decide_share(project, share, seed):
+    from auxiliary_01 import get_table_path, read_table, save_table
+
+    all_data = read_table(get_table_path(project, 'all_data'))
+    rng = np.random.default_rng(seed)
+    decided = all_data.sample(frac=share, random_state=seed)
+    include = rng.random(len(decided)) < 0.3
+    inclusions = decided[include].assign(Inclusion_Importance=rng.integers(1, 6, include.sum()))
+    exclusions = decided[~include].assign(Exclusion_Reason='Limited Relevance to Research')
+    save_table(inclusions, get_table_path(project, 'inclusions'))
+    save_table(exclusions, get_table_path(project, 'exclusions'))
+    return all_data, inclusions, exclusions
+
+
+# Matching all_data against the decision files, as on every startup that has to rebuild the indexes
+def bench_reconciliation(project, seed):
+    from auxiliary_03 import find_decided
+
+    all_data, inclusions, exclusions = decide_share(project, DECIDED_SHARE, seed)
+    is_decided, seconds = timed(find_decided, all_data, [inclusions, exclusions])
+    return stage(seconds, len(all_data) + len(inclusions) + len(exclusions),
+                 decided_found=int(is_decided.sum()), decided_expected=len(inclusions) + len(exclusions))
+
+
+# Rebuilding the exact and near-duplicate indexes from the working tables
+def bench_dedup_index(project):
+    from auxiliary_01 import get_table_path, count_rows
+    from auxiliary_05 import rebuild_dedup_index
+
+    _, seconds = timed(rebuild_dedup_index, project)
+    rows = sum(count_rows(get_table_path(project, name)) for name in ('all_data', 'inclusions', 'exclusions'))
+    return stage(seconds, rows)
+
+
+def bench_review_store(project):
+    from auxiliary_04 import get_review_store
+
+    store, seconds = timed(get_review_store, {}, project)
+    rows = len(store)
+    store.close()
+    return stage(seconds, rows)
+
+
+# Screening through the app: one /action request per decision, then the same number in /decisions batches
+def bench_decisions(client, project, decisions):
+    client.post('/set_project', data={'project': project})
+    page = client.get('/')
+    record_id = re.search(r'data-record-id="([^"]*)"', page.text).group(1)
+    reviewer = re.search(r'data-reviewer="([^"]*)"', page.text).group(1)
+
+    latencies = []
+    for n in range(decisions):
+        if record_id in ('-1', -1):
+            break
+        action = 'include' if n % 3 == 0 else 'exclude'
+        started = time.perf_counter()
+        response = client.post(f'/action/{action}/{record_id}', data={
+            'inclusion_importance': '3', 'exclusion_reason': 'Limited Relevance to Research', 'reviewer': reviewer})
+        latencies.append(time.perf_counter() - started)
+        record_id = response.json()['record_id']
+
+    batch_latencies = []
+    decided = 0
+    while decided < decisions:
+        window = client.post(f'/records/checkout?reviewer={reviewer}&limit={DECISION_BATCH}').json()['records']
+        if not window:
+            break
+        batch = [{'record_id': item['record_id'], 'action': 'exclude',
+                  'exclusion_reason': 'Limited Relevance to Research'} for item in window]
+        started = time.perf_counter()
+        client.post(f'/decisions?reviewer={reviewer}', json=batch)
+        batch_latencies.append((time.perf_counter() - started) / len(batch))
+        decided += len(batch)
+
+    return {"action": latency_summary(latencies) if latencies else None,
+            "batched_per_decision": latency_summary(batch_latencies) if batch_latencies else None}
+
+
+# Venn/UpSet data of the processed source files: the overlap matrix and the UpSet input built from it
+def bench_overlap(project):
+    from post_01_venn_diagram import compute_overlap, source_files
+    from upsetplot import from_indicators
+
+    files = source_files(project)
+    (records, membership, file_rows), overlap_seconds = timed(compute_overlap, files)
+    _, upset_seconds = timed(lambda: from_indicators(membership[membership.any(axis=1)]))
+    return {"overlap": stage(overlap_seconds, sum(file_rows.values()), overlapping_records=len(records)),
+            "upset_data": stage(upset_seconds, len(membership))}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, duplicate_rate, decisions, workspace, seed=23):
+    corpora = prepare_workspace(workspace, sizes, duplicate_rate, seed)
+    os.chdir(workspace)
+    sys.path.insert(0, REPO_DIR)
+    log_file = os.path.join(workspace, 'benchmark.log')
+    # Set up before the app modules are imported, so their logging goes to the log as well
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = {
+        "started": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "storage_format": os.environ.get('STORAGE_FORMAT', 'csv'),
+        "review_store": os.environ.get('REVIEW_STORE', 'memory'),
+        "duplicate_rate": duplicate_rate,
+        "seed": seed,
+        "runs": [],
+    }
+
+    # The app's own output goes to the log, so the console only shows the timings
+    with open(log_file, 'a', encoding='utf-8') as log:
+        for records in sizes:
+            project = project_name(records)
+            run = {"records": records, "corpus": corpora[records], "stages": {}}
+            print(f"{project}: ingest", flush=True)
+            with redirect_stdout(log):
+                run["stages"]["ingest"] = bench_ingest(project, corpora[records])
+            print(f"{project}: reconciliation, dedup index, review store", flush=True)
+            with redirect_stdout(log):
+                run["stages"]["reconciliation"] = bench_reconciliation(project, seed)
+                run["stages"]["dedup_index"] = bench_dedup_index(project)
+                run["stages"]["review_store_load"] = bench_review_store(project)
+            print(f"{project}: overlap", flush=True)
+            with redirect_stdout(log):
+                run["stages"].update(bench_overlap(project))
+            results["runs"].append(run)
+
+        # The app loads every project on startup, so it is started once all of them are ingested
+        print("decisions through the app", flush=True)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        with redirect_stdout(log):
+            import main
+            from fastapi.testclient import TestClient
+            with TestClient(main.app) as client:
+                for run in results["runs"]:
+                    project = project_name(run["records"])
+                    while client.get(f'/status/{project}').json()['state'] not in ('ready', 'failed'):
+                        time.sleep(0.1)
+                    run["stages"]["decisions"] = bench_decisions(client, project, decisions)
+
+    results["finished"] = datetime.now().isoformat(timespec='seconds')
+    return results
+
+
+def stage_seconds(results):
+    seconds = {}
+    for run in results["runs"]:
+        for name, values in run["stages"].items():
+            if "seconds" in values:
+                seconds[(run["records"], name)] = values["seconds"]
+            else:
+                for part, summary in values.items():
+                    if summary is not None:
+                        seconds[(run["records"], f"{name}.{part}")] = summary["p50_ms"] / 1000
+    return seconds
+
+
+# One line per stage and size: earlier time, current time and the ratio between them
+def compare(earlier, current):
+    before = stage_seconds(earlier)
+    after = stage_seconds(current)
+    print(f"{'records':>8}  {'stage':<34}{'before (s)':>12}{'after (s)':>12}{'ratio':>8}")
+    for key in sorted(after, key=lambda key: (key[0], key[1])):
+        if key in before:
+            ratio = after[key] / before[key] if before[key] else float('inf')
+            print(f"{key[0]:>8}  {key[1]:<34}{before[key]:>12.4f}{after[key]:>12.4f}{ratio:>8.2f}")
+
+
+def print_summary(results):
+    for (records, name), seconds in sorted(stage_seconds(results).items()):
+        print(f"{records:>8}  {name:<34}{seconds:>12.4f}s")
+
+
+def option(arguments, name, default):
+    if name in arguments:
+        return arguments[arguments.index(name) + 1]
+    return default
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    sizes = [int(size) for size in option(arguments, '--sizes', ','.join(map(str, DEFAULT_SIZES))).split(',')]
+    duplicate_rate = float(option(arguments, '--duplicate-rate', 0.3))
+    decisions = int(option(arguments, '--decisions', 200))
+    workspace = os.path.abspath(option(arguments, '--workspace', tempfile.mkdtemp(prefix='metafilter-bench-')))
+    output = os.path.abspath(option(arguments, '--output', os.path.join(
+        REPO_DIR, 'benchmarks', 'results', f"{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")))
+    earlier = option(arguments, '--compare', None)
+    earlier = os.path.abspath(earlier) if earlier else None
+
+    results = run_benchmarks(sizes, duplicate_rate, decisions, workspace)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=4)
+    print_summary(results)
+    print(f"Results saved to {output}, workspace and log in {workspace}")
+
+    if earlier:
+        with open(earlier, 'r', encoding='utf-8') as file:
+            compare(json.load(file), results)
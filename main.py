@@ -18,15 +18,21 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from auxiliary_01 import *
+from auxiliary_03 import *
+from auxiliary_04 import *
+from auxiliary_05 import *
 from fastapi import FastAPI, Request, Form, Body, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 import numpy as np
-import shutil
+import time
+import uuid
 
 app = FastAPI()
+app.state.stores = {}
+app.state.ingestion = IngestionWorker()
 app.add_middleware(SessionMiddleware, secret_key='RL23IPH')
 
 templates = Jinja2Templates(directory="templates")
@@ -43,187 +49,68 @@ def read_all_csvs(project):
     return pd.concat(all_dataframes, ignore_index=True) if all_dataframes else pd.DataFrame()
 
 
-def find_and_move_duplicates(project):
+def load_review_store(project):
+    get_review_store(app.state.stores, project)
+
+
+# Times every request under its route template, so /action/include/<id> is one series and not one per record
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        if route is not None:
+            path = route.path
+        elif request.url.path.startswith('/static/'):
+            path = '/static'
+        else:
+            path = 'unmatched'
+        metrics.record_request(request.method, path, status, time.perf_counter() - started)
 
-    avoid_fields = ['ISSN']
 
-    sources_dir = get_project_path(project, 'sources')
-    duplicates_file = get_project_path(project, 'duplicates.csv')
-    combined_file = get_project_path(project, 'all_data.csv')
-    print(combined_file)
+@app.on_event("startup")
+async def startup_event():
+    for project in projects:
+        app.state.ingestion.submit(project, on_ready=load_review_store)
 
-    all_files = [os.path.join(sources_dir, f) for f in os.listdir(sources_dir) if f.endswith('.csv')]
-    all_dataframes = [read_csv(f) for f in all_files]
-    combined_df = pd.concat(all_dataframes, ignore_index=True) if all_dataframes else pd.DataFrame()
-
-    duplicates_df = read_csv(duplicates_file) if os.path.exists(duplicates_file) else pd.DataFrame(columns=combined_df.columns)
-    unique_df = read_csv(combined_file) if os.path.exists(combined_file) else pd.DataFrame(columns=combined_df.columns)
-
-    for idx, record in combined_df.iterrows():
-        unique_dois = set(unique_df['DOI'].dropna()) if (not unique_df.empty and 'DOI' in unique_df.columns) else set()
-        unique_abstracts = set(unique_df['Abstract'].dropna()) if (not unique_df.empty and 'Abstract' in unique_df.columns) else set()
-
-        doi = record.get('DOI')
-        abstract = record.get('Abstract')
-
-        record_df = pd.DataFrame([record])
-
-        def is_in_unique():
-            result = False
-            for _, unique_record in unique_df.iterrows():
-                rec_check = True
-                for field in unique_df.columns:
-                    if field in avoid_fields:
-                        continue
-
-                    if pd.isna(record[field]) and pd.isna(unique_record[field]):
-                        continue
-
-                    try:
-                        if isinstance(record[field], (int, float)) and isinstance(unique_record[field], (int, float)):
-                            if round(float(record[field])) != round(float(unique_record[field])):
-                                rec_check = False
-                                break
-                        else:
-                            if str(record[field]).strip() != str(unique_record[field]).strip():
-                                rec_check = False
-                                break
-                    except ValueError:
-                        rec_check = False
-                        break
-
-                if rec_check:
-                    result = True
-                    break
-
-            return result
-
-        if (
-                (pd.notna(doi) and doi in unique_dois) or
-                (abstract != "[No abstract available]" and abstract in unique_abstracts) or
-                is_in_unique()
-        ):
-            duplicates_df = pd.concat([duplicates_df, record_df], ignore_index=True)
-        else:
-            unique_df = pd.concat([unique_df, record_df], ignore_index=True)
-
-    save_csv(unique_df, combined_file)
-    save_csv(duplicates_df, duplicates_file)
-
-    unique_df = read_csv(combined_file) if os.path.exists(combined_file) else pd.DataFrame(columns=combined_df.columns)
-
-    print(f"3 - Saving Duplicates containing {len(duplicates_df)} records")
-
-    inclusions_file = get_project_path(project, 'inclusions.csv')
-    exclusions_file = get_project_path(project, 'exclusions.csv')
-
-    inclusions_df = read_csv(inclusions_file) if os.path.exists(inclusions_file) else pd.DataFrame()
-    exclusions_df = read_csv(exclusions_file) if os.path.exists(exclusions_file) else pd.DataFrame()
-
-    inclusion_dois = set(inclusions_df['DOI'].dropna()) if (not inclusions_df.empty and 'DOI' in inclusions_df.columns) else set()
-    exclusion_dois = set(exclusions_df['DOI'].dropna()) if (not exclusions_df.empty and 'DOI' in exclusions_df.columns) else set()
-
-    inclusion_abstracts = set(inclusions_df['Abstract'].dropna()) if (not inclusions_df.empty and 'Abstract' in inclusions_df.columns) else set()
-    exclusion_abstracts = set(exclusions_df['Abstract'].dropna()) if (not exclusions_df.empty and 'Abstract' in exclusions_df.columns) else set()
-
-    found_inc_exc = pd.DataFrame(columns=combined_df.columns)
-    new_unique_df = pd.DataFrame(columns=combined_df.columns)
-
-    for idx, record in unique_df.iterrows():
-        doi = record.get('DOI')
-        abstract = record.get('Abstract')
-
-        record_df = pd.DataFrame([record])
-
-        def is_in_inclusions():
-            result = False
-            for _, inclusion_record in inclusions_df.iterrows():
-                rec_check = True
-                for field in unique_df.columns:
-                    if field in avoid_fields:
-                        continue
-
-                    if pd.isna(record[field]) and pd.isna(inclusion_record[field]):
-                        continue
-
-                    try:
-                        if isinstance(record[field], (int, float)) and isinstance(inclusion_record[field], (int, float)):
-                            if round(float(record[field])) != round(float(inclusion_record[field])):
-                                rec_check = False
-                                break
-                        else:
-                            if str(record[field]).strip() != str(inclusion_record[field]).strip():
-                                rec_check = False
-                                break
-                    except ValueError:
-                        rec_check = False
-                        break
-
-                if rec_check:
-                    result = True
-                    break
-
-            return result
-
-        def is_in_exclusions():
-            result = False
-            for _, exclusion_record in exclusions_df.iterrows():
-                rec_check = True
-                for field in unique_df.columns:
-                    if field in avoid_fields:
-                        continue
-
-                    if pd.isna(record[field]) and pd.isna(exclusion_record[field]):
-                        continue
-
-                    try:
-                        if isinstance(record[field], (int, float)) or isinstance(exclusion_record[field], (int, float)):
-                            if round(float(record[field])) != round(float(exclusion_record[field])):
-                                rec_check = False
-                                break
-                        else:
-                            if str(record[field]).strip() != str(exclusion_record[field]).strip():
-                                rec_check = False
-                                break
-                    except ValueError:
-                        rec_check = False
-                        break
-
-                if rec_check:
-                    result = True
-                    break
-
-            return result
-
-        if (
-                (pd.notna(doi) and (doi in inclusion_dois or doi in exclusion_dois)) or
-                (abstract != "[No abstract available]" and (abstract in inclusion_abstracts or abstract in exclusion_abstracts))
-        ):
-            found_inc_exc = pd.concat([found_inc_exc, record_df], ignore_index=True)
-        elif is_in_inclusions() or is_in_exclusions():
-            print("Found in inclusions or exclusions")
-            found_inc_exc = pd.concat([found_inc_exc, record_df], ignore_index=True)
-        else:
-            new_unique_df = pd.concat([new_unique_df, record_df], ignore_index=True)
 
-    save_csv(new_unique_df, combined_file)
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.ingestion.shutdown()
+    for store in app.state.stores.values():
+        store.close()
 
-    print(f"4 - Found {len(found_inc_exc)} records in either inclusions or exclusions")
-    print(f"5 - New unique df contains {len(new_unique_df)} records")
 
-    processed_folder = os.path.join(os.path.dirname(sources_dir), "processed_sources")
+@app.get("/status")
+async def status():
+    return app.state.ingestion.get_status()
 
-    if not os.path.exists(processed_folder):
-        os.makedirs(processed_folder)
 
-    for file in all_files:
-        shutil.move(file, processed_folder)
-        print(f"Moved {file} to {processed_folder}")
+@app.get("/status/{project}")
+async def project_status(project: str):
+    if project not in projects:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return app.state.ingestion.get_status(project)
 
-@app.on_event("startup")
-async def startup_event():
-    for project in projects:
-        find_and_move_duplicates(project)
+
+# Stage and request metrics of this app worker in the Prometheus text format, with the review progress per project
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    statuses = {'total_records': 'pending', 'included_count': 'included', 'excluded_count': 'excluded',
+                'duplicates_count': 'duplicates'}
+    records = [({'project': project, 'status': statuses[name]}, count)
+               for project, store in list(app.state.stores.items()) for name, count in store.counts().items()]
+    ingestion = [({'project': project, 'state': status['state']}, 1)
+                 for project, status in app.state.ingestion.get_status().items()]
+    return metrics.render([
+        ('review_records', 'Records of each project by review status.', records),
+        ('ingestion_state', 'Current ingestion state of each project.', ingestion),
+    ])
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -232,19 +119,17 @@ async def index(request: Request):
     if not project:
         project = projects[0]
 
-    ALL_DATA_FILE = get_project_path(project, 'all_data.csv')
-    INCLUSIONS_FILE = get_project_path(project, 'inclusions.csv')
-    EXCLUSIONS_FILE = get_project_path(project, 'exclusions.csv')
     INC_EXC_CRITERIA_FILE = get_project_path(project, 'inc_exc_criteria.txt')
     SELECTED_FIELDS_FILE = get_project_path(project, 'selected_fields.txt')
 
-    all_data_df = read_csv(ALL_DATA_FILE)
-    inclusions_df = read_csv(INCLUSIONS_FILE)
-    exclusions_df = read_csv(EXCLUSIONS_FILE)
     static_info = read_static_info(INC_EXC_CRITERIA_FILE)
 
-    if all_data_df.empty:
-        message = "No more records."
+    ingest_state = app.state.ingestion.state(project)
+    if ingest_state != READY:
+        if ingest_state == FAILED:
+            message = f"Processing sources failed: {app.state.ingestion.get_status(project)['error']}"
+        else:
+            message = "Processing new sources, records will appear when it finishes."
         return templates.TemplateResponse("index.html", {
             "request": request,
             "project": project,
@@ -253,14 +138,33 @@ async def index(request: Request):
             "static_info": static_info,
             "record_id": -1,
             "selected_fields": [],
-            "total_records": len(all_data_df),
-            "included_count": len(inclusions_df),
-            "excluded_count": len(exclusions_df),
-            "duplicates_count": len(read_csv(get_project_path(project, 'duplicates.csv'))),
+            "total_records": 0,
+            "included_count": 0,
+            "excluded_count": 0,
+            "duplicates_count": 0,
+            "ingest_state": ingest_state,
             "message": message
         })
 
-    record = all_data_df.iloc[0].to_dict()
+    store = get_review_store(app.state.stores, project)
+    # One reviewer per browser session, so the page, its form posts and its batched decisions share the leases
+    reviewer = request.session.setdefault('reviewer', uuid.uuid4().hex)
+    window = store.checkout(reviewer, 1)
+    record_id, record = window[0] if window else (-1, None)
+
+    if record is None:
+        message = "No more records."
+        return templates.TemplateResponse("index.html", {
+            "request": request,
+            "project": project,
+            "projects": projects,
+            "record": {},
+            "static_info": static_info,
+            "record_id": -1,
+            "selected_fields": [],
+            **store.counts(),
+            "message": message
+        })
 
     selected_fields = read_static_info(SELECTED_FIELDS_FILE) if os.path.exists(SELECTED_FIELDS_FILE) else list(record.keys())
 
@@ -270,12 +174,10 @@ async def index(request: Request):
         "projects": projects,
         "record": record,
         "static_info": static_info,
-        "record_id": 0,
+        "record_id": record_id,
+        "reviewer": reviewer,
         "selected_fields": selected_fields,
-        "total_records": len(all_data_df),
-        "included_count": len(inclusions_df),
-        "excluded_count": len(exclusions_df),
-        "duplicates_count": len(read_csv(get_project_path(project, 'duplicates.csv'))),
+        **store.counts(),
         "message": ""
     })
 
@@ -288,66 +190,157 @@ async def set_project(request: Request, project: str = Form(...)):
     return RedirectResponse(url="/", status_code=303)
 
 
+def sanitize_for_json(data):
+    if isinstance(data, dict):
+        return {k: (None if (v is pd.NA or (isinstance(v, float) and (np.isnan(v) or np.isinf(v)))) else v) for k, v in data.items()}
+    return data
+
+
+def trim_record(record, selected_fields):
+    if selected_fields:
+        record = {key: record[key] for key in selected_fields if key in record}
+    return sanitize_for_json(record)
+
+
+# Requests from a page name the project it was rendered for, which the session may have moved on from since
+def request_project(request, project=None):
+    project = project or request.session.get('project') or projects[0]
+    if project not in projects:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return project
+
+
+def ready_store(project):
+    ingest_state = app.state.ingestion.state(project)
+    if ingest_state != READY:
+        return None, {"status": ingest_state, "message": f"Project {project} is not ready for screening ({ingest_state})"}
+    return get_review_store(app.state.stores, project), None
+
+
 @app.post("/action/{action}/{record_id}")
-async def action(action: str, record_id: int, request: Request,
+async def action(action: str, record_id: str, request: Request,
                  inclusion_importance: int = Form(None),
-                 exclusion_reason: str = Form(None)):
+                 exclusion_reason: str = Form(None),
+                 reviewer: str = Form(None)):
     project = request.session.get('project')
     if not project:
         project = projects[0]
 
-    INCLUSIONS_FILE = get_project_path(project, 'inclusions.csv')
-    EXCLUSIONS_FILE = get_project_path(project, 'exclusions.csv')
-    DUPLICATES_FILE = get_project_path(project, 'duplicates.csv')
-    ALL_DATA_FILE = get_project_path(project, 'all_data.csv')
     SELECTED_FIELDS_FILE = get_project_path(project, 'selected_fields.txt')
 
-    all_data_df = read_csv(ALL_DATA_FILE)
-    inclusions_df = read_csv(INCLUSIONS_FILE)
-    exclusions_df = read_csv(EXCLUSIONS_FILE)
-    duplicates_df = read_csv(DUPLICATES_FILE)
-
-    record = all_data_df.iloc[record_id]
-
-    if action == "include":
-        record["Inclusion_Importance"] = inclusion_importance
-        inclusions_df = pd.concat([inclusions_df, pd.DataFrame([record])], ignore_index=True)
-        save_csv(inclusions_df, INCLUSIONS_FILE)
-    elif action == "exclude":
-        record["Exclusion_Reason"] = exclusion_reason
-        exclusions_df = pd.concat([exclusions_df, pd.DataFrame([record])], ignore_index=True)
-        save_csv(exclusions_df, EXCLUSIONS_FILE)
-
-    all_data_df = all_data_df.drop(all_data_df.index[record_id])
-    save_csv(all_data_df, ALL_DATA_FILE)
-
-    all_data_df = read_csv(ALL_DATA_FILE)
-    if not all_data_df.empty:
-        next_record_id = 0
-        next_record = all_data_df.iloc[next_record_id].to_dict()
-    else:
-        next_record_id = -1
-        next_record = {}
+    store, not_ready = ready_store(project)
+    if store is None:
+        return not_ready
 
-    selected_fields = read_static_info(SELECTED_FIELDS_FILE)
-    if selected_fields:
-        next_record = {key: next_record[key] for key in selected_fields if key in next_record}
+    if action not in DECISION_ACTIONS:
+        raise HTTPException(status_code=422, detail=f"Invalid action: {action}")
+    if not reviewer:
+        reviewer = request.session.setdefault('reviewer', uuid.uuid4().hex)
 
-    def sanitize_for_json(data):
-        if isinstance(data, dict):
-            return {k: (None if (isinstance(v, float) and (np.isnan(v) or np.isinf(v))) else v) for k, v in data.items()}
-        return data
+    try:
+        store.decide(record_id, action, inclusion_importance, exclusion_reason, reviewer)
+    except LeaseConflict:
+        raise HTTPException(status_code=409, detail="Record is checked out by another reviewer")
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Record not found")
 
-    next_record = sanitize_for_json(next_record)
+    window = store.checkout(reviewer, 1)
+    next_record_id, next_record = window[0] if window else (-1, {})
 
     return {
         "status": "success",
         "record_id": next_record_id,
-        "record": next_record,
-        "total_records": len(all_data_df),
-        "included_count": len(inclusions_df),
-        "excluded_count": len(exclusions_df),
-        "duplicates_count": len(duplicates_df)
+        "record": trim_record(next_record, read_static_info(SELECTED_FIELDS_FILE)),
+        **store.counts()
+    }
+
+
+# Leases the next records nobody else is screening to this reviewer, trimmed to the selected fields, for the
+# client's prefetch buffer; limit=0 only renews the reviewer's current leases
+@app.post("/records/checkout")
+async def checkout_records(request: Request, reviewer: str, limit: int = 20, project: str = None):
+    project = request_project(request, project)
+
+    SELECTED_FIELDS_FILE = get_project_path(project, 'selected_fields.txt')
+
+    store, not_ready = ready_store(project)
+    if store is None:
+        return not_ready
+
+    selected_fields = read_static_info(SELECTED_FIELDS_FILE)
+    window = store.checkout(reviewer, max(0, min(limit, 200)))
+    return {
+        "status": "success",
+        "records": [{"record_id": record_id, "record": trim_record(record, selected_fields)} for record_id, record in window],
+        "lease_seconds": LEASE_SECONDS,
+        **store.counts()
+    }
+
+
+# Hands back the records a page holds and will not screen. Only the listed records are released: other pages of
+# the same session share the reviewer and keep theirs.
+@app.post("/records/release")
+async def release_records(request: Request, reviewer: str, record_ids: list = Body(None), project: str = None):
+    project = request_project(request, project)
+
+    store, not_ready = ready_store(project)
+    if store is None:
+        return not_ready
+
+    record_ids = [record_id for record_id in record_ids or [] if isinstance(record_id, str)]
+    if record_ids:
+        store.release(reviewer, record_ids)
+    return {"status": "success", "released": len(record_ids)}
+
+
+# A batch of decisions queued by the client: [{"record_id", "action", "inclusion_importance", "exclusion_reason"}, ...]
+@app.post("/decisions")
+async def decisions(request: Request, batch: list = Body(...), reviewer: str = None, project: str = None):
+    project = request_project(request, project)
+
+    store, not_ready = ready_store(project)
+    if store is None:
+        return not_ready
+
+    for decision in batch:
+        if not isinstance(decision, dict) or not isinstance(decision.get("record_id"), str) \
+                or decision.get("action") not in DECISION_ACTIONS:
+            raise HTTPException(status_code=422, detail=f"Invalid decision: {decision}")
+
+    decided, missing, conflicts = store.decide_many(batch, reviewer)
+    return {
+        "status": "success",
+        "decided": len(decided),
+        "missing": missing,
+        "conflicts": conflicts,
+        **store.counts()
+    }
+
+
+# Full-text search over Title, Abstract and Author Keywords; tables is a comma-separated subset of SEARCH_TABLES
+@app.get("/search")
+async def search(request: Request, q: str, tables: str = None, offset: int = 0, limit: int = 20):
+    project = request.session.get('project')
+    if not project:
+        project = projects[0]
+
+    store, not_ready = ready_store(project)
+    if store is None:
+        return not_ready
+
+    selected_tables = tables.split(',') if tables else SEARCH_TABLES
+    if any(table not in SEARCH_TABLES for table in selected_tables):
+        raise HTTPException(status_code=422, detail=f"tables must be among {', '.join(SEARCH_TABLES)}")
+
+    offset = max(0, offset)
+    total, results = store.search(q, selected_tables, offset, max(1, min(limit, 100)))
+    return {
+        "status": "success",
+        "query": q,
+        "total": total,
+        "offset": offset,
+        "results": [{"table": table, "record_id": record_id if table == 'all_data' else None,
+                     "record": sanitize_for_json(result_record(record))} for table, record_id, record in results]
     }
 
 
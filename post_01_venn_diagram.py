@@ -17,63 +17,41 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import os
-import pandas as pd
+import hashlib
+import json
+import sys
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from upsetplot import UpSet, from_memberships
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from auxiliary_01 import *
+from auxiliary_03 import KEY_FIELDS, key_columns
+from upsetplot import UpSet, from_indicators
 from venn import venn
 
-PROJECTS_DIR = 'projects'
-projects = [name for name in os.listdir(PROJECTS_DIR) if os.path.isdir(os.path.join(PROJECTS_DIR, name))]
-
-
-def get_project_path(project_name, filename):
-    return os.path.join(PROJECTS_DIR, project_name, filename)
-
-
-def read_csv(file_path):
-    return pd.read_csv(file_path) if os.path.exists(file_path) else pd.DataFrame()
-
-
-def save_csv(df, file_path):
-    print(f"Saving {file_path}")
-    df.to_csv(file_path, index=False)
+# A record belongs to an existing venn_id when any of these keys matches
+OVERLAP_KEYS = ['EID', 'DOI_Key', 'Abstract_Key']
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
 
 
 # Create UpSet Plot
-def plot_upset_plot(venn_diagram_data, filenames, project):
-    idx = []
-    for f in filenames:
-        x = venn_diagram_data.columns.get_loc(f)
-        idx.append(x)
-
-    source_columns = venn_diagram_data.columns[idx]
-
-    # Create membership sets for each combination of sources
-    memberships = []
-    for idx, row in venn_diagram_data.iterrows():
-        membership = tuple(col for col in source_columns if row[col] == 1)
-        if membership:
-            memberships.append(membership)
-
-    # Generate the projects for the UpSet plot
-    upset_data = from_memberships(memberships)
+def plot_upset_plot(membership, file_path):
+    # Each row of the membership matrix is one record and its combination of sources
+    upset_data = from_indicators(membership[membership.any(axis=1)])
 
     # Plot the UpSet diagram
+    fig = plt.figure(figsize=(10, 6))
     upset = UpSet(upset_data, subset_size='count', show_counts='%d', sort_by='cardinality')
-    upset.plot()
-    plt.title("UpSet Plot for Overlapping Records")
-    plt.savefig(get_project_path(project, "upset_plot.png"))
+    upset.plot(fig=fig)
+    fig.suptitle("UpSet Plot for Overlapping Records")
+    fig.savefig(file_path)
+    plt.close(fig)
 
 
-def plot_venn_diagram(venn_diagram_data, filenames, project):
+def plot_venn_diagram(membership, file_path):
     # Create a dictionary to hold sets of venn_ids for each file
-    sets_dict = {}
-
-    for filename in filenames:
-        # Get the set of venn_ids where the file column has value 1
-        file_set = set(venn_diagram_data.loc[venn_diagram_data[filename] == 1, 'venn_id'])
-        sets_dict[filename] = file_set
+    sets_dict = {filename: set(membership.index[membership[filename]]) for filename in membership.columns}
 
     # Check if there are more than 6 sets and slice the first 6
     if len(sets_dict) > 6:
@@ -81,66 +59,199 @@ def plot_venn_diagram(venn_diagram_data, filenames, project):
         sets_dict = {k: sets_dict[k] for k in list(sets_dict.keys())[:6]}
 
     # Plot the Venn diagram using the 'venn' package
-    venn(sets_dict)
+    fig, ax = plt.subplots(figsize=(8, 8))
+    venn(sets_dict, ax=ax)
 
     # Save the Venn diagram plot
-    plt.title("Venn Diagram for Overlapping Records")
-    plt.savefig(get_project_path(project, "venn_diagram.png"))
-    plt.show()
-    print(f"Venn Diagram saved as PNG: {get_project_path(project, 'venn_diagram.png')}")
-
-
-def find_and_move_duplicates(project):
-    processed_sources_dir = get_project_path(project, 'processed_sources')
-    all_files = [os.path.join(processed_sources_dir, f) for f in os.listdir(processed_sources_dir) if
-                 f.endswith('.csv')]
-
-    inclusions_file = get_project_path(project, 'inclusions.csv')
-    if os.path.exists(inclusions_file):
-        all_files.append(inclusions_file)
-
-    venn_diagram_data = pd.DataFrame(columns=['EID', 'DOI', 'Abstract'])
-
+    ax.set_title("Venn Diagram for Overlapping Records")
+    fig.savefig(file_path)
+    plt.close(fig)
+    print(f"Venn Diagram saved as PNG: {file_path}")
+
+
+def plot_prisma_flow(counts, file_path):
+    boxes = [
+        f"Records identified\n(n = {counts['identified']})",
+        f"Records after duplicates removed\n(n = {counts['screened'] + counts['awaiting_screening']})",
+        f"Records screened\n(n = {counts['screened']})",
+        f"Studies included\n(n = {counts['included']})",
+    ]
+    side_boxes = [
+        f"Duplicates removed\n(n = {counts['duplicates_removed']})",
+        f"Awaiting screening\n(n = {counts['awaiting_screening']})",
+        "Records excluded\n(n = {})".format(counts['excluded']) + ''.join(
+            f"\n{reason}: {n}" for reason, n in counts['exclusion_reasons'].items()),
+    ]
+
+    fig, ax = plt.subplots(figsize=(8, 10))
+    ax.set_axis_off()
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    style = dict(ha='center', va='center', fontsize=10, bbox=dict(boxstyle='round', facecolor='white', edgecolor='black'))
+    heights = [0.88, 0.63, 0.38, 0.13]
+    for i, (text, y) in enumerate(zip(boxes, heights)):
+        ax.text(0.3, y, text, **style)
+        if i + 1 < len(heights):
+            ax.annotate('', xy=(0.3, heights[i + 1] + 0.05), xytext=(0.3, y - 0.05), arrowprops=dict(arrowstyle='->'))
+    for text, y in zip(side_boxes, [0.755, 0.505, 0.255]):
+        ax.text(0.78, y, text, **style)
+        ax.annotate('', xy=(0.6, y), xytext=(0.3, y), arrowprops=dict(arrowstyle='->'))
+
+    ax.set_title("PRISMA Flow of Records")
+    fig.savefig(file_path)
+    plt.close(fig)
+
+
+# Assigns every record a venn_id through dict lookups on its EID, DOI and abstract keys.
+# Returns the first record seen for each venn_id, a boolean matrix of which files each venn_id appears in,
+# and the number of records in each file.
+def compute_overlap(files):
+    venn_ids = {}
+    first_records = []
+    hit_ids = []
+    hit_files = []
     filenames = []
+    file_rows = {}
+    next_id = 0
 
-    venn_counter = 1
-
-    for file in all_files:
+    for position, file in enumerate(files):
         filename = os.path.splitext(os.path.basename(file))[0]
         filenames.append(filename)
-        f = read_csv(file)
+        f = read_table(file)
+        file_rows[filename] = len(f)
 
         print(f"Processing file: {filename}")
+        if f.empty:
+            continue
+
+        f[KEY_FIELDS] = key_columns(f)
+        keys = f.reindex(columns=OVERLAP_KEYS).astype(object)
+        keys = keys.where(keys.notna(), None)
+
+        new_rows = []
+        for row, values in enumerate(keys.itertuples(index=False, name=None)):
+            record_keys = [(field, value) for field, value in zip(OVERLAP_KEYS, values) if value is not None]
+            matched = {venn_ids[key] for key in record_keys if key in venn_ids}
+            if not matched:
+                matched = {next_id}
+                next_id += 1
+                new_rows.append(row)
+            # Keys first seen on a later copy of a record still lead back to it
+            for key in record_keys:
+                venn_ids.setdefault(key, min(matched))
+            hit_ids.extend(matched)
+            hit_files.extend([position] * len(matched))
+
+        if new_rows:
+            first_records.append(f.iloc[new_rows])
+
+    records = pd.concat(first_records, ignore_index=True) if first_records else pd.DataFrame()
+    records.insert(0, 'venn_id', np.arange(1, next_id + 1))
+
+    matrix = np.zeros((next_id, len(filenames)), dtype=bool)
+    matrix[np.array(hit_ids, dtype=np.int64), np.array(hit_files, dtype=np.int64)] = True
+    membership = pd.DataFrame(matrix, index=pd.Index(records['venn_id'], name='venn_id'), columns=filenames)
+    return records, membership, file_rows
+
+
+# Record counts for each stage of the PRISMA flow, from the project's working tables
+def prisma_counts(project, source_rows):
+    exclusions = read_table(get_table_path(project, 'exclusions'), columns=['Exclusion_Reason'])
+    reasons = exclusions['Exclusion_Reason'].fillna('Not given').value_counts() if not exclusions.empty else pd.Series()
+    return {
+        "identified": int(sum(source_rows.values())),
+        "identified_by_source": {name: int(rows) for name, rows in source_rows.items()},
+        "duplicates_removed": count_rows(get_table_path(project, 'duplicates')),
+        "awaiting_screening": count_rows(get_table_path(project, 'all_data')),
+        "screened": count_rows(get_table_path(project, 'inclusions')) + len(exclusions),
+        "excluded": len(exclusions),
+        "exclusion_reasons": {str(reason): int(n) for reason, n in reasons.items()},
+        "included": count_rows(get_table_path(project, 'inclusions')),
+    }
+
+
+def source_files(project):
+    processed_sources_dir = get_project_path(project, 'processed_sources')
+    if not os.path.isdir(processed_sources_dir):
+        return []
+    return sorted(os.path.join(processed_sources_dir, f) for f in os.listdir(processed_sources_dir) if f.endswith('.csv'))
+
+
+# Changes whenever a source file or working table is added, removed or rewritten
+def data_signature(project):
+    files = source_files(project) + [get_project_path(project, f"{name}{extension}")
+                                     for name in WORKING_TABLES for extension in STORAGE_EXTENSIONS.values()]
+    digest = hashlib.sha256()
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            digest.update(f"{file}\x1f{stat.st_size}\x1f{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Computes the overlap once and renders every figure of one project; skipped when nothing changed since the last run
+def render_project(project, force=False):
+    manifest_file = get_project_path(project, 'figures_manifest.json')
+    signature = data_signature(project)
+    if not force and os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        if manifest['signature'] == signature and all(os.path.exists(output) for output in manifest['outputs']):
+            print(f"{project}: figures are up to date")
+            return False
+
+    sources = source_files(project)
+    if not sources:
+        print(f"{project}: no processed sources, nothing to render")
+        return False
+
+    all_files = list(sources)
+    inclusions_file = get_table_path(project, 'inclusions')
+    if table_exists(inclusions_file):
+        all_files.append(inclusions_file)
 
-        for idx, record in f.iterrows():
-            eid = record.get('EID')
-            doi = record.get('DOI')
-            abstract = record.get("Abstract")
-            record_df = pd.DataFrame([record])
-
-            eid_exists = pd.notna(eid) and venn_diagram_data['EID'].isin([eid]).any()
-            doi_exists = pd.notna(doi) and venn_diagram_data['DOI'].isin([doi]).any()
-            abstract_exists = pd.notna(abstract) and venn_diagram_data['Abstract'].isin([abstract]).any()
-
-            if eid_exists or doi_exists or abstract_exists:
-                if filename not in venn_diagram_data.columns:
-                    venn_diagram_data[filename] = 0
-                venn_diagram_data.loc[(venn_diagram_data['EID'] == eid) |
-                                      (venn_diagram_data['DOI'] == doi) |
-                                      (venn_diagram_data['Abstract'] == abstract), filename] += 1
-            else:
-                record_df['venn_id'] = venn_counter
-                venn_counter += 1
-                record_df[filename] = 1
-                venn_diagram_data = pd.concat([venn_diagram_data, record_df], ignore_index=True)
-
-    save_csv(venn_diagram_data, 'dev_local/venn_diagram_data.csv')
-
-    # Generate the UpSet plot after processing
-    plot_upset_plot(venn_diagram_data, filenames, project)
-
-    plot_venn_diagram(venn_diagram_data, filenames, project)
-
-
-# Run for the specified project
-find_and_move_duplicates('phd_litreview1')
+    records, membership, file_rows = compute_overlap(all_files)
+    source_names = [os.path.splitext(os.path.basename(file))[0] for file in sources]
+    counts = prisma_counts(project, {name: file_rows[name] for name in source_names})
+
+    outputs = [get_project_path(project, name) for name in ('venn_diagram_data.csv', 'prisma_counts.json', 'prisma_flow.png')]
+    save_csv(records.join(membership.astype(int), on='venn_id'), outputs[0])
+    with open(outputs[1], 'w', encoding='utf-8') as file:
+        json.dump(counts, file, indent=4)
+    plot_prisma_flow(counts, outputs[2])
+    # The venn package needs two to six sets
+    if len(membership.columns) >= 2:
+        outputs.append(get_project_path(project, 'venn_diagram.png'))
+        plot_venn_diagram(membership, outputs[-1])
+    if membership.any(axis=1).any():
+        outputs.append(get_project_path(project, 'upset_plot.png'))
+        plot_upset_plot(membership, outputs[-1])
+
+    with open(manifest_file, 'w', encoding='utf-8') as file:
+        json.dump({"signature": signature, "outputs": outputs}, file, indent=4)
+    print(f"{project}: rendered figures for {len(records)} records from {len(sources)} sources")
+    return True
+
+
+def _render(args):
+    project, force = args
+    try:
+        return project, render_project(project, force), None
+    except Exception as e:
+        return project, False, repr(e)
+
+
+def render_all(project_names, force=False, workers=RENDER_WORKERS):
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(project_names)))) as executor:
+        for project, rendered, error in executor.map(_render, [(project, force) for project in project_names]):
+            if error is not None:
+                print(f"{project}: rendering failed: {error}")
+
+
+# Usage: python post_01_venn_diagram.py [--force] [project ...]; renders every project when none is given
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    force = '--force' in arguments
+    selected = [argument for argument in arguments if argument != '--force'] or projects
+    if selected:
+        render_all(selected, force)
@@ -19,11 +19,15 @@
 
 from auxiliary_01 import *
 from auxiliary_02 import *
+from auxiliary_03 import canonical_doi
 
 project = "phd_litreview1"
 
-inclusions_file = get_project_path(project, 'inclusions.csv')
-inclusions_df = read_csv(inclusions_file) if os.path.exists(inclusions_file) else pd.DataFrame()
+inclusions_file = get_table_path(project, 'inclusions')
+inclusions_df = read_table(inclusions_file, columns=['DOI', 'DOI_Key', 'Inclusion_Importance'])
+# Records ingested with key columns already carry the canonical DOI
+if 'DOI_Key' in inclusions_df.columns:
+    inclusions_df['DOI'] = inclusions_df['DOI_Key'].fillna(inclusions_df['DOI'])
 
 dois_file = get_project_path(project, "dois.csv")
 dois_df = read_csv(dois_file) if os.path.exists(dois_file) else pd.DataFrame()
@@ -42,6 +46,7 @@ new_dois = pd.DataFrame({
 })
 
 dois_df = pd.concat([dois_df, new_dois], ignore_index=True)
+dois_df['DOI'] = dois_df['DOI'].map(canonical_doi, na_action='ignore')
 
 dois_df = dois_df.drop_duplicates(subset=['DOI']).reset_index(drop=True)
 
@@ -68,33 +73,6 @@ os.makedirs(pdf_folder, exist_ok=True)
 # if dois_df.empty:
 #     logging.warning('     No DOIs found in the file.')
 
-for index, row in dois_df.iterrows():
-    doi = row['DOI']
-    inclusion_importance = row['Inclusion_Importance']
-
-    logging.info(f'     Processing DOI: {doi} with Inclusion Importance: {inclusion_importance}')
-
-    importance_folder = os.path.join(save_folder, f"Importance_{inclusion_importance}")
-    importance_pdf_folder = os.path.join(pdf_folder, f"Importance_{inclusion_importance}")
-
-    os.makedirs(importance_folder, exist_ok=True)
-    os.makedirs(importance_pdf_folder, exist_ok=True)
-
-    data = fetch_unpaywall_data(doi, email)
-    if data:
-        save_unpaywall_data(doi, data, importance_folder)
-        pdf_url = find_pdf_links(data)
-        if pdf_url:
-            if download_pdf(pdf_url, importance_pdf_folder):
-                continue
-
-    resolved_url = resolve_doi(doi)
-    if resolved_url:
-        if download_pdf(resolved_url, importance_pdf_folder):
-            continue
-        else:
-            logging.info(f'Opening URL in browser: {resolved_url}')
-            webbrowser.open_new_tab(resolved_url)
-    else:
-        logging.warning(f'Could not resolve DOI: {doi}')
-        webbrowser.open_new_tab(f"{DOI_URL_PREFIX}{doi}")
\ No newline at end of file
+cache = ResponseCache(get_project_path(project, "http_cache"))
+
+download_inclusions(dois_df, save_folder, pdf_folder, email, cache=cache)
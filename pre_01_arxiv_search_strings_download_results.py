@@ -17,9 +17,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import requests
 import csv
+import json
+import logging
+import threading
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote_plus
+from auxiliary_01 import *
+from auxiliary_02 import shared_session, rate_limiter
+
+project = "phd_litreview1"
+
+ARXIV_API_URL = 'http://export.arxiv.org/api/query'
+ARXIV_PAGE_SIZE = int(os.environ.get('ARXIV_PAGE_SIZE', 500))
+ARXIV_WORKERS = int(os.environ.get('ARXIV_WORKERS', 4))
+# arXiv asks clients to wait three seconds between calls
+rate_limiter.intervals['export.arxiv.org'] = 3.0
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+ARXIV = '{http://arxiv.org/schemas/atom}'
+OPENSEARCH = '{http://a9.com/-/spec/opensearch/1.1/}'
+ARXIV_FIELDS = ["Title", "Authors", "Published Date", "Abstract", "Link", "DOI", "arXiv ID"]
 
 search_queries = {
     "1-a": '"Artificial Intelligence" AND ("Criminal Justice" OR "Law Enforcement") AND ("UK" OR "United Kingdom" OR "Britain")',
@@ -52,53 +73,186 @@ search_queries = {
 }
 
 
-def fetch_arxiv_data(api_url):
-    response = requests.get(api_url)
-    if response.status_code == 200:
-        return response.text
-    else:
+def fetch_arxiv_page(query, start):
+    api_url = (f'{ARXIV_API_URL}?search_query={quote_plus(query)}&start={start}&max_results={ARXIV_PAGE_SIZE}'
+               f'&sortBy=submittedDate&sortOrder=descending')
+    rate_limiter.wait(api_url)
+    response = shared_session().get(api_url, stream=True, timeout=60)
+    if response.status_code != 200:
         print(f"Error: {response.status_code}")
+        response.close()
         return None
+    response.raw.decode_content = True
+    return response
+
+
+def _text(entry, tag):
+    element = entry.find(tag)
+    return ' '.join(element.text.split()) if element is not None and element.text else ''
+
+
+# Yields one row per <entry> as it is read, clearing each element afterwards so memory does not grow with the page;
+# feed['total'] is set from opensearch:totalResults, which arrives before the entries
+def parse_arxiv_entries(stream, feed):
+    for _, element in ET.iterparse(stream, events=('end',)):
+        if element.tag == f'{OPENSEARCH}totalResults':
+            feed['total'] = int(element.text)
+        elif element.tag == f'{ATOM}entry':
+            arxiv_id = _text(element, f'{ATOM}id').rsplit('/abs/', 1)[-1]
+            pdf_url = next((link.attrib['href'] for link in element.findall(f'{ATOM}link')
+                            if link.attrib.get('title') == 'pdf'), 'No PDF available')
+            yield {
+                "Title": _text(element, f'{ATOM}title'),
+                "Authors": ', '.join(_text(author, f'{ATOM}name') for author in element.findall(f'{ATOM}author')),
+                "Published Date": _text(element, f'{ATOM}published'),
+                "Abstract": _text(element, f'{ATOM}summary'),
+                "Link": pdf_url,
+                "DOI": _text(element, f'{ARXIV}doi'),
+                # Versions of one paper share an ID
+                "arXiv ID": arxiv_id.rsplit('v', 1)[0] if arxiv_id.rsplit('v', 1)[-1].isdigit() else arxiv_id,
+            }
+            element.clear()
+
+
+# IDs already in the project from any query, so a paper matched by several queries is saved once
+class SeenIds:
 
+    def __init__(self, ids=()):
+        self.lock = threading.Lock()
+        self.ids = set(ids)
 
-def parse_arxiv_data(xml_data):
-    root = ET.fromstring(xml_data)
-    entries = []
+    def add(self, arxiv_id):
+        with self.lock:
+            if arxiv_id in self.ids:
+                return False
+            self.ids.add(arxiv_id)
+            return True
 
-    for entry in root.findall('{http://www.w3.org/2005/Atom}entry'):
-        title = entry.find('{http://www.w3.org/2005/Atom}title').text
-        authors = ', '.join([author.find('{http://www.w3.org/2005/Atom}name').text for author in
-                             entry.findall('{http://www.w3.org/2005/Atom}author')])
-        published_date = entry.find('{http://www.w3.org/2005/Atom}published').text
-        summary = entry.find('{http://www.w3.org/2005/Atom}summary').text if entry.find(
-            '{http://www.w3.org/2005/Atom}summary') is not None else ''
 
-        title = title.replace('\n', ' ').strip()
-        summary = summary.replace('\n', ' ').strip()
+# Per-query harvest state: the newest 'published' timestamp fetched and every arXiv ID the query returned.
+# Changing the text of a query drops its state, so it is harvested again from scratch.
+class HarvestState:
 
-        pdf_link_element = entry.find('{http://arxiv.org/schemas/atom}link[@title="pdf"]')
-        pdf_url = pdf_link_element.attrib['href'] if pdf_link_element is not None else 'No PDF available'
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.queries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self.queries = json.load(file)
 
-        entries.append([title, authors, published_date, summary, pdf_url])
+    def get(self, search_key, query):
+        with self.lock:
+            entry = self.queries.get(search_key)
+            return dict(entry) if entry is not None and entry['query'] == query else None
+
+    def all_ids(self):
+        with self.lock:
+            return {arxiv_id for entry in self.queries.values() for arxiv_id in entry['seen_ids']}
+
+    def update(self, search_key, query, ids, last_published):
+        with self.lock:
+            entry = self.queries.get(search_key)
+            if entry is None or entry['query'] != query:
+                entry = self.queries[search_key] = {'query': query, 'last_published': None, 'seen_ids': []}
+            entry['seen_ids'] = sorted(set(entry['seen_ids']) | set(ids))
+            if last_published is not None:
+                entry['last_published'] = max(entry['last_published'] or '', last_published)
+            entry['harvested_at'] = datetime.now().isoformat(timespec='seconds')
+
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self.queries, file, indent=4)
+            os.replace(tmp_path, self.path)
+
+
+# Pages through one query, newest submissions first, writing rows to the project's sources folder as they are parsed.
+# With a previous harvest it stops at the first entry older than the last one fetched, so the file only holds new papers.
+# The file only gets its .csv name once paging stops, so ingestion never sees a file still being written. When paging
+# fails partway the rows fetched so far are kept in a -partial.csv file, and the next run fetches the rest.
+def harvest_query(search_key, query, seen, sources_dir, state):
+    previous = state.get(search_key, query)
+    since = previous['last_published'] if previous else None
+    known = set(previous['seen_ids']) if previous else set()
+
+    name = f"arxiv-{search_key}-{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    tmp_path = os.path.join(sources_dir, f"{name}.csv.tmp")
+    written = duplicates = start = 0
+    ids = []
+    newest = None
+    complete = False
+    feed = {}
+
+    with open(tmp_path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=ARXIV_FIELDS)
+        writer.writeheader()
+        try:
+            while True:
+                response = fetch_arxiv_page(query, start)
+                if response is None:
+                    break
+                entries = 0
+                caught_up = False
+                with response:
+                    for row in parse_arxiv_entries(response.raw, feed):
+                        if since is not None and row["Published Date"] < since:
+                            caught_up = True
+                            break
+                        entries += 1
+                        newest = max(newest or '', row["Published Date"])
+                        ids.append(row["arXiv ID"])
+                        if row["arXiv ID"] in known:
+                            continue
+                        if seen.add(row["arXiv ID"]):
+                            writer.writerow(row)
+                            written += 1
+                        else:
+                            duplicates += 1
+                start += entries
+                if caught_up or entries < ARXIV_PAGE_SIZE or start >= feed.get('total', 0):
+                    complete = True
+                    break
+        except Exception:
+            logging.exception(f"Paging failed for query {search_key} after {start} entries")
+
+    # An interrupted query keeps its IDs but not its date, so the next run looks back far enough to finish it
+    state.update(search_key, query, ids, newest if complete else None)
+
+    if written:
+        filename = os.path.join(sources_dir, f"{name}.csv" if complete else f"{name}-partial.csv")
+        os.replace(tmp_path, filename)
+        print(f"Results saved to {filename}: {written} new entries, {duplicates} already found by another query")
+        if not complete:
+            print(f"Query {search_key} stopped before its last page; the next run fetches the rest")
+    else:
+        os.remove(tmp_path)
+        print(f"No new results for query {search_key}")
+    return written
 
-    return entries
 
+def harvest_arxiv(project, queries, workers=ARXIV_WORKERS):
+    sources_dir = get_project_path(project, 'sources')
+    os.makedirs(sources_dir, exist_ok=True)
+    state = HarvestState(get_project_path(project, 'arxiv_state.json'))
+    seen = SeenIds(state.all_ids())
+    started = time.perf_counter()
 
-def save_to_csv(data, filename):
-    with open(filename, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(["Title", "Authors", "Published Date", "Abstract", "Link"])
-        writer.writerows(data)
-    print(f"Results saved to {filename}")
+    # One failing query is logged and the others carry on
+    def harvest(item):
+        try:
+            return harvest_query(item[0], item[1], seen, sources_dir, state)
+        except Exception:
+            logging.exception(f"Harvest failed for query {item[0]}")
+            return None
 
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='arxiv') as executor:
+        results = list(executor.map(harvest, queries.items()))
 
-for search_key, query in search_queries.items():
-    encoded_query = query.replace(' ', '+')
+    written = sum(result for result in results if result is not None)
+    failed = sum(result is None for result in results)
+    print(f"Harvested {written} new arXiv entries from {len(queries) - failed} of {len(queries)} queries "
+          f"in {time.perf_counter() - started:.1f}s")
 
-    api_url = f'http://export.arxiv.org/api/query?search_query={encoded_query}&max_results=1000'
 
-    xml_data = fetch_arxiv_data(api_url)
-    if xml_data:
-        parsed_data = parse_arxiv_data(xml_data)
-        if parsed_data:
-            save_to_csv(parsed_data, f'arxiv-{search_key}.csv')
+if __name__ == '__main__':
+    harvest_arxiv(project, search_queries)
@@ -17,45 +17,225 @@
 // You should have received a copy of the GNU General Public License
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-async function handleAction(event, action, recordId) {
+const PREFETCH_SIZE = 20;
+const PREFETCH_LOW_WATER = 5;
+const DECISION_BATCH_SIZE = 10;
+const DECISION_FLUSH_DELAY_MS = 2000;
+const LEASE_HEARTBEAT_MS = 60000;
+const SEARCH_PAGE_SIZE = 20;
+
+// Records already fetched from the server, shown one after another without waiting for it
+var recordBuffer = [];
+var currentRecordId = -1;
+var reviewer = null;
+var pageProject = null;
+var currentRecordTitle = '';
+var heartbeatTimer = null;
+var prefetching = null;
+var noMoreRecords = false;
+
+// Decisions taken locally and not yet acknowledged by the server
+var decisionQueue = [];
+var flushTimer = null;
+var flushing = null;
+// Titles of queued decisions, to name the ones another reviewer got to first
+var decisionTitles = {};
+
+var searchParams = null;
+var searchOffset = 0;
+
+// Query string every screening request carries, so it reaches the project this page was rendered for
+function pageParams(extra) {
+    return new URLSearchParams(Object.assign({reviewer: reviewer, project: pageProject}, extra || {}));
+}
+
+function showNotice(text) {
+    var notice = document.querySelector('#status .screening-notice');
+    if (!notice) {
+        notice = document.createElement('p');
+        notice.className = 'message screening-notice';
+        document.querySelector('#status').appendChild(notice);
+    }
+    notice.innerText = text;
+}
+
+function readCount(selector) {
+    return parseInt(document.querySelector(selector).innerText.replace(/\D/g, ''), 10) || 0;
+}
+
+async function prefetchRecords() {
+    if (prefetching || noMoreRecords) {
+        return prefetching;
+    }
+    // Every record in the buffer is leased to this page, so other reviewers never get it
+    var url = `/records/checkout?${pageParams({limit: PREFETCH_SIZE})}`;
+    prefetching = fetch(url, {method: 'POST'})
+    .then(response => response.json())
+    .then(result => {
+        if (result.status !== 'success') {
+            console.error(result.message);
+            return;
+        }
+        result.records.forEach(item => recordBuffer.push(item));
+        if (result.records.length < PREFETCH_SIZE) {
+            noMoreRecords = true;
+        }
+    })
+    .catch(error => console.error('Error:', error))
+    .finally(() => { prefetching = null; });
+    return prefetching;
+}
+
+function flushDecisions() {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+    if (flushing || decisionQueue.length === 0) {
+        return flushing;
+    }
+    var batch = decisionQueue.slice(0, DECISION_BATCH_SIZE);
+    flushing = fetch(`/decisions?${pageParams()}`, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(batch),
+    })
+    .then(response => response.json())
+    .then(result => {
+        if (result.status !== 'success') {
+            console.error(result.message || result.detail);
+            return;
+        }
+        decisionQueue.splice(0, batch.length);
+        if (result.conflicts && result.conflicts.length > 0) {
+            var titles = result.conflicts.map(recordId => decisionTitles[recordId] || recordId);
+            showNotice(`Not saved, another reviewer has these records: ${titles.join('; ')}`);
+        }
+        batch.forEach(decision => { delete decisionTitles[decision.record_id]; });
+        if (decisionQueue.length === 0) {
+            updateCounts(result.total_records, result.included_count, result.excluded_count, result.duplicates_count);
+        }
+    })
+    .catch(error => console.error('Error:', error))
+    .finally(() => {
+        flushing = null;
+        if (decisionQueue.length >= DECISION_BATCH_SIZE) {
+            flushDecisions();
+        } else if (decisionQueue.length > 0) {
+            scheduleFlush();
+        }
+    });
+    return flushing;
+}
+
+function scheduleFlush() {
+    if (decisionQueue.length >= DECISION_BATCH_SIZE) {
+        flushDecisions();
+    } else if (!flushTimer) {
+        flushTimer = setTimeout(flushDecisions, DECISION_FLUSH_DELAY_MS);
+    }
+}
+
+async function showNextRecord() {
+    if (recordBuffer.length === 0) {
+        // Records other reviewers released or let expire become available again
+        noMoreRecords = false;
+        await prefetchRecords();
+    }
+    var next = recordBuffer.shift();
+    if (recordBuffer.length < PREFETCH_LOW_WATER) {
+        prefetchRecords();
+    }
+    if (!next) {
+        currentRecordId = -1;
+        updateRecord({}, -1);
+        return;
+    }
+    currentRecordId = next.record_id;
+    currentRecordTitle = next.record.Title || next.record['Document Title'] || '';
+    updateRecord(next.record, next.record_id);
+}
+
+async function handleAction(event, action) {
     event.preventDefault();
 
     const form = event.target;
-    const formData = new FormData(form);
+    if (currentRecordId === -1) {
+        return;
+    }
+
+    var decision = {record_id: currentRecordId, action: action, inclusion_importance: null, exclusion_reason: null};
 
     if (action === 'exclude') {
-        const exclusionReason = form.querySelector('select[name="exclusion_reason"]').value;
-        formData.append('inclusion_importance', '');
-        formData.append('exclusion_reason', exclusionReason);
+        decision.exclusion_reason = form.querySelector('select[name="exclusion_reason"]').value;
+        updateCounts(readCount('.total-records') - 1, readCount('.included-count'), readCount('.excluded-count') + 1, readCount('.duplicates-count'));
     }
 
     if (action === 'include') {
-        const inclusionImportance = form.querySelector('select[name="inclusion_importance"]').value;
-        formData.append('inclusion_importance', inclusionImportance);
-        formData.append('exclusion_reason', '');
+        decision.inclusion_importance = parseInt(form.querySelector('select[name="inclusion_importance"]').value, 10);
+        updateCounts(readCount('.total-records') - 1, readCount('.included-count') + 1, readCount('.excluded-count'), readCount('.duplicates-count'));
     }
 
-    try {
-        const response = await fetch(`/action/${action}/${recordId}`, {
-            method: 'POST',
-            body: formData,
-        });
+    decisionTitles[currentRecordId] = currentRecordTitle || currentRecordId;
+    decisionQueue.push(decision);
+    scheduleFlush();
+    await showNextRecord();
+}
 
-        const result = await response.json();
-        console.log(result); // Log the entire result object
-        if (result.status === 'success') {
-            updateRecord(result.record, result.record_id, result.total_records, result.included_count, result.excluded_count, result.duplicates_count);
-        } else {
-            console.error(result.message);
-        }
-    } catch (error) {
-        console.error('Error:', error);
+// Renews the leases on the current record and the buffer while the reviewer is reading
+function renewLeases() {
+    fetch(`/records/checkout?${pageParams({limit: 0})}`, {method: 'POST'})
+    .catch(error => console.error('Error:', error));
+}
+
+function initialiseScreening() {
+    var details = document.querySelector('.record-details');
+    if (!details || details.dataset.recordId === undefined) {
+        return;
+    }
+    reviewer = details.dataset.reviewer;
+    pageProject = details.dataset.project;
+    currentRecordId = details.dataset.recordId;
+    var title = document.querySelector('#field_Title, #field_Document\\ Title');
+    currentRecordTitle = title ? title.innerText.replace(/^[^:]*:\s*/, '') : '';
+    if (currentRecordId === '-1') {
+        currentRecordId = -1;
+        return;
     }
+    heartbeatTimer = setInterval(renewLeases, LEASE_HEARTBEAT_MS);
+    prefetchRecords();
 }
 
-function updateRecord(record, recordId, totalRecords, includedCount, excludedCount, duplicatesCount) {
+// Sends whatever is still queued when the page is hidden or closed
+function flushOnExit() {
+    if (decisionQueue.length === 0) {
+        return;
+    }
+    var blob = new Blob([JSON.stringify(decisionQueue)], {type: 'application/json'});
+    if (navigator.sendBeacon(`/decisions?${pageParams()}`, blob)) {
+        decisionQueue = [];
+    }
+}
+
+// Hands the records this page holds back to the other reviewers when it is closed. Only this page's records are
+// named: a reload or another tab of the same session has leased its own by the time the beacon arrives.
+function releaseOnExit() {
+    var queued = new Set(decisionQueue.map(decision => decision.record_id));
+    flushOnExit();
+    if (reviewer === null) {
+        return;
+    }
+    clearInterval(heartbeatTimer);
+    // Records with a decision on its way keep their lease, so nobody else gets them before it lands
+    var held = [currentRecordId].concat(recordBuffer.map(item => item.record_id))
+        .filter(recordId => recordId !== -1 && !queued.has(recordId));
+    if (held.length === 0) {
+        return;
+    }
+    var blob = new Blob([JSON.stringify(held)], {type: 'application/json'});
+    navigator.sendBeacon(`/records/release?${pageParams()}`, blob);
+}
+
+function updateRecord(record, recordId) {
     console.log(`Updating record with ID: ${recordId}`);
-    console.log(`Total Records: ${totalRecords}, Included: ${includedCount}, Excluded: ${excludedCount}, Duplicates: ${duplicatesCount}`);
 
     if (recordId === -1) {
         document.querySelector('.record-details').innerHTML = "<p>No more records.</p>";
@@ -66,11 +246,18 @@ function updateRecord(record, recordId, totalRecords, includedCount, excludedCou
     recordDetails.innerHTML = '';
 
     for (const [key, value] of Object.entries(record)) {
+        if (value === null || value === '') {
+            continue;
+        }
         const li = document.createElement('li');
         li.id = `field_${key}`;
         li.innerHTML = `<strong>${key}:</strong> ${value}`;
         recordDetails.appendChild(li);
     }
+}
+
+function updateCounts(totalRecords, includedCount, excludedCount, duplicatesCount) {
+    console.log(`Total Records: ${totalRecords}, Included: ${includedCount}, Excluded: ${excludedCount}, Duplicates: ${duplicatesCount}`);
 
     // Update the status bar with the new counts
     document.querySelector('.total-records').innerText = `Records: ${totalRecords}`;
@@ -82,6 +269,10 @@ function updateRecord(record, recordId, totalRecords, includedCount, excludedCou
 function toggleField(field) {
     var checkBox = document.getElementById('check_' + field);
     var fieldDiv = document.getElementById('field_' + field);
+    if (!fieldDiv) {
+        saveFieldSelection();
+        return;
+    }
     if (checkBox.checked) {
         fieldDiv.style.display = '';
     } else {
@@ -127,4 +318,78 @@ function loadFieldSelection() {
     });
 }
 
+const SEARCH_TABLE_LABELS = {all_data: 'Remaining', inclusions: 'Included', exclusions: 'Excluded', duplicates: 'Duplicates'};
+
+function runSearch(event) {
+    event.preventDefault();
+    const form = event.target;
+    searchParams = new URLSearchParams({q: form.querySelector('input[name="q"]').value, limit: SEARCH_PAGE_SIZE});
+    const tables = form.querySelector('select[name="tables"]').value;
+    if (tables) {
+        searchParams.set('tables', tables);
+    }
+    searchOffset = 0;
+    document.querySelector('.search-results').innerHTML = '';
+    loadSearchPage();
+}
+
+function loadSearchPage() {
+    if (searchParams === null) {
+        return;
+    }
+    searchParams.set('offset', searchOffset);
+    fetch(`/search?${searchParams}`)
+    .then(response => response.json())
+    .then(result => {
+        if (result.status !== 'success') {
+            console.error(result.message || result.detail);
+            return;
+        }
+        const list = document.querySelector('.search-results');
+        result.results.forEach(item => {
+            const li = document.createElement('li');
+            const label = document.createElement('strong');
+            label.textContent = `${SEARCH_TABLE_LABELS[item.table]}: `;
+            li.appendChild(label);
+            const year = item.record.Year ? ` (${item.record.Year})` : '';
+            li.appendChild(document.createTextNode(`${item.record.Title || item.record.DOI || ''}${year}`));
+            if (item.record.Exclusion_Reason) {
+                li.appendChild(document.createTextNode(` - ${item.record.Exclusion_Reason}`));
+            }
+            list.appendChild(li);
+        });
+        searchOffset += result.results.length;
+        document.querySelector('.search-total').innerText = `${result.total} records found`;
+        document.querySelector('.search-more').hidden = searchOffset >= result.total;
+    })
+    .catch(error => console.error('Error:', error));
+}
+
+function pollIngestStatus() {
+    var statusElement = document.querySelector('.ingest-status');
+    if (!statusElement) {
+        return;
+    }
+    var state = statusElement.dataset.state;
+    if (state !== 'queued' && state !== 'processing') {
+        return;
+    }
+
+    fetch(`/status/${encodeURIComponent(statusElement.dataset.project)}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.state === 'queued' || data.state === 'processing') {
+            statusElement.innerText = `Status: ${data.state}`;
+            setTimeout(pollIngestStatus, 2000);
+        } else {
+            window.location.reload();
+        }
+    })
+    .catch(error => console.error('Error:', error));
+}
+
 document.addEventListener('DOMContentLoaded', loadFieldSelection);
+document.addEventListener('DOMContentLoaded', pollIngestStatus);
+document.addEventListener('DOMContentLoaded', initialiseScreening);
+document.addEventListener('visibilitychange', () => { if (document.visibilityState === 'hidden') flushOnExit(); });
+window.addEventListener('pagehide', releaseOnExit);
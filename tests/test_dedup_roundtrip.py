@@ -0,0 +1,78 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auxiliary_05 import find_and_move_duplicates, get_table_path, read_table
+
+# A Scopus export row with no DOI or abstract, so only the exact fingerprint can match its copy
+SCOPUS_ROW = {
+    'Authors': 'Taylor B., Wilson N.', 'Title': 'Accountability of artificial intelligence', 'Year': '2005',
+    'Source title': 'Journal of Predictive Machines', 'Volume': '36', 'Issue': '8', 'Page start': '375',
+    'Page end': '385', 'Cited by': '7', 'DOI': '', 'Abstract': '', 'Publisher': 'Elsevier', 'ISSN': '0788-0110',
+    'Document Type': 'Article', 'Source': 'Scopus', 'EID': '2-s2.0-29751780251',
+}
+
+
+def write_source(project_dir, name, blank_lines=0):
+    sources_dir = os.path.join(project_dir, 'sources')
+    os.makedirs(sources_dir, exist_ok=True)
+    pd.DataFrame([SCOPUS_ROW]).to_csv(os.path.join(sources_dir, name), index=False)
+    # Trailing blank lines give the same export another digest, so it is ingested again
+    with open(os.path.join(sources_dir, name), 'a') as file:
+        file.write('\n' * blank_lines)
+
+
+# Keys built from the text of a new source must match keys rebuilt from the typed working files
+def test_exact_duplicate_found_after_index_rebuild(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    project_dir = os.path.join('projects', 'p')
+
+    write_source(project_dir, 'a.csv')
+    find_and_move_duplicates('p')
+    os.remove(os.path.join(project_dir, 'dedup_index.csv'))
+    write_source(project_dir, 'b.csv', blank_lines=1)
+    find_and_move_duplicates('p')
+
+    duplicates_df = read_table(get_table_path('p', 'duplicates'))
+    assert len(read_table(get_table_path('p', 'all_data'))) == 1
+    assert len(duplicates_df) == 1
+    # Found as an exact duplicate, not by the near-duplicate stage
+    assert 'Duplicate_Of' not in duplicates_df.columns or duplicates_df['Duplicate_Of'].isna().all()
+
+
+# Two harvests of one preprint with no DOI, the second after a revision changed its title and abstract
+def test_arxiv_records_without_doi_match_on_their_id(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sources_dir = os.path.join('projects', 'p', 'sources')
+    os.makedirs(sources_dir)
+    for name, title, version in (('a.csv', 'Learning to rank preprints', 'v1'), ('b.csv', 'Ranking revised', 'v3')):
+        pd.DataFrame([{'Title': title, 'Authors': 'Taylor B.', 'Published Date': '2021-01-04T10:00:00Z',
+                       'Abstract': f'{title} abstract', 'Link': f'http://arxiv.org/abs/2101.00001{version}',
+                       'DOI': '', 'arXiv ID': '2101.00001'}]).to_csv(os.path.join(sources_dir, name), index=False)
+        find_and_move_duplicates('p')
+
+    all_data = read_table(get_table_path('p', 'all_data'))
+    assert all_data['arXiv ID'].tolist() == ['2101.00001']
+    assert all_data['DOI_Key'].tolist() == ['10.48550/arxiv.2101.00001']
+    assert len(read_table(get_table_path('p', 'duplicates'))) == 1
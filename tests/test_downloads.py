@@ -0,0 +1,168 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auxiliary_02
+import requests
+from auxiliary_02 import CACHE_MISS, DownloadManifest, ResponseCache, download_pdf, fetch_unpaywall_data, \
+    requests_retry_session
+
+PDF = b'%PDF-1.4\n' + bytes(range(256)) * 64
+
+
+# Serves PDF at every path and honours Range headers; 'wrong_range' answers every range from byte 0
+class StubHandler(BaseHTTPRequestHandler):
+    mode = 'range'
+    requests = []
+
+    def do_GET(self):
+        StubHandler.requests.append((self.path, self.headers.get('Range')))
+        if self.path.startswith('/v2/'):
+            return self.unpaywall()
+        start = 0
+        if self.headers.get('Range') and self.mode != 'ignore_range':
+            start = 0 if self.mode == 'wrong_range' else int(self.headers['Range'][6:].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(PDF) - 1}/{len(PDF)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(PDF) - start))
+        self.end_headers()
+        self.wfile.write(PDF[start:])
+
+    # Unpaywall: DOIs starting with 404 or 500 get that status, any other DOI an answer naming its PDF
+    def unpaywall(self):
+        doi = self.path[4:].split('?')[0]
+        status = int(doi[:3]) if doi[:3] in ('404', '500') else 200
+        body = json.dumps({'doi': doi, 'best_oa_location': {'url_for_pdf': f'/{doi}.pdf'}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(auxiliary_02.rate_limiter, 'interval', 0)
+    monkeypatch.setattr(StubHandler, 'mode', 'range')
+    StubHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def interrupted_download(tmp_path, url, filename):
+    with open(tmp_path / f'{filename}.part', 'wb') as file:
+        file.write(PDF[:1000])
+    with open(tmp_path / f'{filename}.part.url', 'w', encoding='utf-8') as file:
+        file.write(url)
+
+
+@pytest.mark.parametrize('mode', ['range', 'ignore_range', 'wrong_range'])
+def test_interrupted_download_ends_with_the_whole_file(tmp_path, server, mode):
+    StubHandler.mode = mode
+    url = f'{server}/paper.pdf'
+    interrupted_download(tmp_path, url, 'a.pdf')
+    manifest = DownloadManifest(str(tmp_path / 'pdf_manifest.json'))
+
+    assert download_pdf(url, str(tmp_path), requests_retry_session(), manifest, 'a.pdf')
+    assert (tmp_path / 'a.pdf').read_bytes() == PDF
+    assert not os.path.exists(tmp_path / 'a.pdf.part')
+    assert StubHandler.requests[0] == ('/paper.pdf', 'bytes=1000-')
+    # A range that does not continue the partial file is fetched again in full
+    assert len(StubHandler.requests) == (2 if mode == 'wrong_range' else 1)
+
+
+def test_partial_file_of_another_url_is_not_resumed(tmp_path, server):
+    interrupted_download(tmp_path, f'{server}/other.pdf', 'a.pdf')
+    assert download_pdf(f'{server}/paper.pdf', str(tmp_path), requests_retry_session(), filename='a.pdf')
+    assert (tmp_path / 'a.pdf').read_bytes() == PDF
+    assert StubHandler.requests == [('/paper.pdf', None)]
+
+
+def test_manifest_skips_downloaded_files_and_copies_them_for_other_names(tmp_path, server):
+    url = f'{server}/paper.pdf'
+    session = requests_retry_session()
+    manifest = DownloadManifest(str(tmp_path / 'pdf_manifest.json'))
+    assert download_pdf(url, str(tmp_path), session, manifest, 'a.pdf')
+    assert download_pdf(url, str(tmp_path), session, manifest, 'a.pdf')
+    # A second DOI resolving to the same URL gets its own file without another request
+    assert download_pdf(url, str(tmp_path), session, DownloadManifest(manifest.path), 'b.pdf')
+    assert (tmp_path / 'b.pdf').read_bytes() == PDF
+    assert len(StubHandler.requests) == 1
+
+    os.remove(tmp_path / 'a.pdf')
+    assert download_pdf(url, str(tmp_path), session, DownloadManifest(manifest.path), 'a.pdf')
+    assert len(StubHandler.requests) == 1
+
+
+def unpaywall_requests():
+    return len([path for path, _ in StubHandler.requests if path.startswith('/v2/')])
+
+
+def test_unpaywall_answers_and_misses_are_cached_but_not_server_errors(tmp_path, server, monkeypatch):
+    monkeypatch.setattr(auxiliary_02, 'UNPAYWALL_API_URL', f'{server}/v2/')
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    session = requests.Session()
+    for _ in range(2):
+        assert fetch_unpaywall_data('10.1/x', 'a@b.c', session, cache)['doi'] == '10.1/x'
+        assert fetch_unpaywall_data('404/missing', 'a@b.c', session, cache) is None
+        assert fetch_unpaywall_data('500/busy', 'a@b.c', session, cache) is None
+    assert unpaywall_requests() == 4
+    assert cache.get('unpaywall', '404/missing') is None
+    assert cache.get('unpaywall', '500/busy') is CACHE_MISS
+
+
+def test_cache_entries_expire_and_the_oldest_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'), ttl=60, negative_ttl=1)
+    cache.put('doi', 'found', 'https://example.org/a')
+    cache.put('doi', 'missing', None)
+    stored = time.time() - 30
+    for kind, key in (('doi', 'found'), ('doi', 'missing')):
+        with open(cache._file(kind, key), encoding='utf-8') as file:
+            entry = json.load(file)
+        entry['stored'] = stored
+        with open(cache._file(kind, key), 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+    # Negative answers expire sooner than found ones
+    assert cache.get('doi', 'found') == 'https://example.org/a'
+    assert cache.get('doi', 'missing') is CACHE_MISS
+
+    for n in range(10):
+        cache.put('doi', f'key-{n}', 'x' * 100)
+        os.utime(cache._file('doi', f'key-{n}'), (time.time() - 10 + n, time.time() - 10 + n))
+    cache.max_bytes = 5 * os.path.getsize(cache._file('doi', 'key-9'))
+    cache.evict()
+    assert [cache.get('doi', f'key-{n}') is CACHE_MISS for n in range(10)] == [True] * 6 + [False] * 4
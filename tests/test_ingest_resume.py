@@ -0,0 +1,88 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auxiliary_01
+import auxiliary_05
+from auxiliary_05 import find_and_move_duplicates, get_table_path, read_table
+
+
+# Records with titles that share no words, so none of them is a near-duplicate of another
+def write_source(name, start, count, extra_column=False):
+    titles = [' '.join(hashlib.sha256(f'{i}-{word}'.encode()).hexdigest()[:10] for word in range(8))
+              for i in range(start, start + count)]
+    df = pd.DataFrame({'Title': titles, 'Year': [str(2000 + i % 20) for i in range(start, start + count)]})
+    if extra_column:
+        df['Notes'] = 'resumed'
+    os.makedirs(os.path.join('projects', 'p', 'sources'), exist_ok=True)
+    df.to_csv(os.path.join('projects', 'p', 'sources', name), index=False)
+
+
+# Fails the second time it is called, as a crash part way through the second chunk would
+def crash_on_second_call(monkeypatch, owner, name):
+    original = getattr(owner, name)
+    calls = []
+
+    def crashing(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError('crash')
+        return original(*args, **kwargs)
+    monkeypatch.setattr(owner, name, crashing)
+
+
+@pytest.mark.parametrize('storage', ['csv', 'parquet'])
+@pytest.mark.parametrize('crash_point', ['append_keys', 'save_part'])
+def test_rerun_after_a_crash_ingests_every_record_once(tmp_path, monkeypatch, storage, crash_point):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(auxiliary_01, 'STORAGE_FORMAT', storage)
+    monkeypatch.setattr(auxiliary_05, 'INGEST_CHUNK_ROWS', 10)
+    write_source('a.csv', 0, 15)
+    find_and_move_duplicates('p')
+
+    # The second source has a column the first lacked, so the CSV table is rewritten by its first append
+    write_source('b.csv', 100, 25, extra_column=True)
+    with monkeypatch.context() as crash:
+        if crash_point == 'append_keys':
+            crash_on_second_call(crash, auxiliary_05, 'append_keys')
+        else:
+            crash_on_second_call(crash, auxiliary_05.NearDuplicateIndex, 'save_part')
+        with pytest.raises(RuntimeError):
+            find_and_move_duplicates('p')
+
+    summary = find_and_move_duplicates('p')
+    all_data = read_table(get_table_path('p', 'all_data'))
+    assert len(all_data) == 40
+    assert all_data['Title'].is_unique
+    assert read_table(get_table_path('p', 'duplicates')).empty
+    assert summary['rows'] == 25 and summary['added'] == 25
+    assert len(pd.read_csv(os.path.join('projects', 'p', 'dedup_index.csv'))) == 40
+    assert len(auxiliary_05.NearDuplicateIndex.load(os.path.join('projects', 'p', 'minhash_index.npz'))) == 40
+    with open(os.path.join('projects', 'p', 'ingest_manifest.json'), encoding='utf-8') as file:
+        manifest = json.load(file)
+    assert 'in_progress' not in manifest
+    assert sorted(entry['rows'] for entry in manifest['files'].values()) == [15, 25]
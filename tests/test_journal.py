@@ -0,0 +1,81 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auxiliary_04 import ReviewStore, get_table_path, read_table, save_table
+
+
+def write_project(records=5):
+    os.makedirs(os.path.join('projects', 'p'), exist_ok=True)
+    pd.DataFrame({'Title': [f'Paper {i}' for i in range(records)], 'Year': [2000 + i for i in range(records)]}) \
+        .to_csv(os.path.join('projects', 'p', 'all_data.csv'), index=False)
+
+
+def decide_three(store):
+    first, second, third = [record_id for record_id, _ in store.checkout('a', 3)]
+    store.decide(first, 'include', 3, None, 'a')
+    store.decide(second, 'exclude', None, 'Out of scope', 'a')
+    store.decide(third, 'include', 1, None, 'a')
+
+
+# The process dies after journaling decisions and before any compaction, mid-way through writing one more
+def test_journaled_decisions_are_replayed_after_a_crash(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_project()
+    store = ReviewStore('p')
+    decide_three(store)
+    store.journal.close()
+    with open(os.path.join('projects', 'p', 'decisions.jsonl'), 'a', encoding='utf-8') as file:
+        file.write('{"fingerprint": "torn')
+
+    store = ReviewStore('p')
+    assert store.counts()['included_count'] == 2
+    assert store.counts()['excluded_count'] == 1
+    assert store.counts()['total_records'] == 2
+    assert [record['Inclusion_Importance'] for record in store.inclusions] == [3, 1]
+    store.close()
+
+    assert len(read_table(get_table_path('p', 'all_data'))) == 2
+    assert read_table(get_table_path('p', 'exclusions'))['Exclusion_Reason'].tolist() == ['Out of scope']
+    assert not os.path.exists(os.path.join('projects', 'p', 'decisions.jsonl.compacting'))
+
+
+# Compaction wrote the decision files, then the process died before all_data was rewritten
+def test_crash_during_compaction_does_not_decide_a_record_twice(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_project()
+    store = ReviewStore('p')
+    decide_three(store)
+    store.journal.rotate()
+    save_table(store._decisions_df(store.inclusions, store.inclusions_columns), store.inclusions_file)
+    save_table(store._decisions_df(store.exclusions, store.exclusions_columns), store.exclusions_file)
+    store.journal.close()
+
+    store = ReviewStore('p')
+    assert store.counts() == {'total_records': 2, 'included_count': 2, 'excluded_count': 1, 'duplicates_count': 0}
+    decided = {record['Title'] for record in store.inclusions + store.exclusions}
+    assert not decided & {record['Title'] for _, record in store.checkout('b', 5)}
+    store.close()
+    assert len(read_table(get_table_path('p', 'inclusions'))) == 2
+    assert len(read_table(get_table_path('p', 'all_data'))) == 2
@@ -0,0 +1,139 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auxiliary_04 import LeaseConflict, ReviewStore, SqliteReviewStore
+
+
+def write_project(project, records=6):
+    os.makedirs(os.path.join('projects', project), exist_ok=True)
+    pd.DataFrame({'Title': [f'{project} paper {i}' for i in range(records)], 'Year': [2000 + i for i in range(records)]}) \
+        .to_csv(os.path.join('projects', project, 'all_data.csv'), index=False)
+
+
+@pytest.fixture(params=[ReviewStore, SqliteReviewStore])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_project('p')
+    store = request.param('p')
+    yield store
+    store.close()
+
+
+def test_reviewers_get_different_records(store):
+    first = [record_id for record_id, _ in store.checkout('a', 3)]
+    second = [record_id for record_id, _ in store.checkout('b', 3)]
+    assert len(first) == len(second) == 3
+    assert not set(first) & set(second)
+    assert store.checkout('c', 3) == []
+
+
+def test_decision_on_another_reviewers_lease_is_a_conflict(store):
+    record_id, _ = store.checkout('a', 1)[0]
+    with pytest.raises(LeaseConflict):
+        store.decide(record_id, 'include', 3, None, 'b')
+    decided, missing, conflicts = store.decide_many([{'record_id': record_id, 'action': 'exclude'}], 'b')
+    assert conflicts == [record_id]
+    store.decide(record_id, 'include', 3, None, 'a')
+    assert store.counts()['included_count'] == 1
+
+
+def test_expired_lease_goes_to_the_next_reviewer(store):
+    record_id, _ = store.checkout('a', 1, lease_seconds=0)[0]
+    assert store.checkout('b', 1)[0][0] == record_id
+    with pytest.raises(LeaseConflict):
+        store.decide(record_id, 'include', 3, None, 'a')
+
+
+def test_release_only_hands_back_the_listed_records(store):
+    held = [record_id for record_id, _ in store.checkout('a', 2)]
+    store.release('a', held[:1])
+    # Only the released record is free again; another reviewer's release changes nothing
+    store.release('b', held[1:])
+    assert [record_id for record_id, _ in store.checkout('b', 6)][0] == held[0]
+    assert held[1] not in [record_id for record_id, _ in store.checkout('c', 6)]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    import main
+    from fastapi.testclient import TestClient
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.chdir(tmp_path)
+    os.symlink(os.path.join(root, 'templates'), 'templates')
+    write_project('p')
+    write_project('q')
+    monkeypatch.setattr(main, 'projects', ['p', 'q'])
+    monkeypatch.setattr(main.app.state, 'stores', {})
+    client = TestClient(main.app)
+    yield client
+    for store in main.app.state.stores.values():
+        store.close()
+
+
+def page_lease(page):
+    return page.split('data-record-id="')[1].split('"')[0], page.split('data-reviewer="')[1].split('"')[0]
+
+
+def free_records(client, project):
+    response = client.post(f'/records/checkout?reviewer=other&project={project}&limit=6')
+    free = [record['record_id'] for record in response.json()['records']]
+    client.post(f'/records/release?reviewer=other&project={project}', json=free)
+    return free
+
+
+# A reloaded page leases its record before the old page's release beacon arrives
+def test_release_beacon_of_a_reloaded_page_keeps_the_new_pages_record(client):
+    old_record, reviewer = page_lease(client.get('/').text)
+    new_record, _ = page_lease(client.get('/').text)
+    assert old_record != new_record
+
+    client.post(f'/records/release?reviewer={reviewer}&project=p', json=[])
+    assert old_record not in free_records(client, 'p')
+    client.post(f'/records/release?reviewer={reviewer}&project=p', json=[old_record])
+    free = free_records(client, 'p')
+    assert old_record in free and new_record not in free
+
+
+def test_release_after_switching_project_reaches_the_pages_project(client):
+    record_id, reviewer = page_lease(client.get('/').text)
+    client.post('/set_project', data={'project': 'q'})
+    other_record, _ = page_lease(client.get('/').text)
+
+    client.post(f'/records/release?reviewer={reviewer}&project=p', json=[record_id])
+    assert record_id in free_records(client, 'p')
+    assert other_record not in free_records(client, 'q')
+
+
+# Only include and exclude are decisions; anything else would take the record out of the queue unrecorded
+def test_unknown_actions_leave_the_record_pending(client):
+    record_id, reviewer = page_lease(client.get('/').text)
+    response = client.post(f'/decisions?reviewer={reviewer}&project=p', json=[{'record_id': record_id, 'action': 'skip'}])
+    assert response.status_code == 422
+    assert client.post(f'/action/skip/{record_id}', data={'reviewer': reviewer}).status_code == 422
+
+    client.post(f'/records/release?reviewer={reviewer}&project=p', json=[record_id])
+    assert record_id in free_records(client, 'p')
@@ -0,0 +1,70 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auxiliary_04 import SqliteReviewStore, get_table_path, read_table
+
+RECORDS = 60
+
+
+# One app worker process: screens records until none are left, and returns the IDs it decided
+def screen_in_worker(directory, reviewer):
+    os.chdir(directory)
+    store = SqliteReviewStore('p')
+    decided_ids = []
+    while True:
+        window = [record_id for record_id, _ in store.checkout(reviewer, 3)]
+        if not window:
+            break
+        batch = [{'record_id': record_id, 'action': 'include' if int(record_id[-1], 16) % 2 else 'exclude',
+                  'inclusion_importance': 2, 'exclusion_reason': 'Off topic'} for record_id in window]
+        decided, missing, conflicts = store.decide_many(batch, reviewer)
+        assert not missing and not conflicts
+        decided_ids += window
+    store.close()
+    return decided_ids
+
+
+# Worker processes share review.db the way several uvicorn workers do
+def test_concurrent_workers_decide_every_record_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('projects', 'p'))
+    pd.DataFrame({'Title': [f'Paper {i}' for i in range(RECORDS)], 'Year': [2000 + i % 20 for i in range(RECORDS)]}) \
+        .to_csv(os.path.join('projects', 'p', 'all_data.csv'), index=False)
+    SqliteReviewStore('p').close()
+
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        results = pool.starmap(screen_in_worker, [(str(tmp_path), f'reviewer-{n}') for n in range(4)])
+
+    decided_ids = [record_id for ids in results for record_id in ids]
+    assert len(decided_ids) == len(set(decided_ids)) == RECORDS
+
+    store = SqliteReviewStore('p')
+    counts = store.counts()
+    store.close()
+    assert counts['total_records'] == 0
+    assert counts['included_count'] + counts['excluded_count'] == RECORDS
+    assert read_table(get_table_path('p', 'all_data')).empty
+    assert len(read_table(get_table_path('p', 'inclusions'))) == counts['included_count']
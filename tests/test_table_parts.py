@@ -0,0 +1,67 @@
+# A tool for streamlining systematic literature reviews, combining CSV
+# projects from diverse databases, standardising results on a local web page
+# for efficient duplicate detection, inclusion/exclusion tracking, and
+# PRISMA-aligned visualisations and supporting files.
+# Copyright (C) 2024  Ricardo Lopes  rics.23@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auxiliary_01 import _parts_dir, append_table, compact_table, read_table, save_table
+
+
+# Chunks of one source disagree on types: a column that is empty in one chunk and text or numbers in another
+CHUNKS = [
+    pd.DataFrame({'Title': ['First', 'Second'], 'Year': [2001, 2002], 'DOI': [None, None]}),
+    pd.DataFrame({'Title': ['Third'], 'Year': [2003.0], 'DOI': ['10.1/x']}),
+    pd.DataFrame({'Title': ['Fourth', 'Fifth'], 'Year': [None, 2005], 'DOI': ['10.1/y', None], 'Cited by': [3, 4]}),
+]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_parts_compact_to_the_appended_rows(tmp_path, extension):
+    file_path = str(tmp_path / f'all_data{extension}')
+    save_table(pd.DataFrame({'Title': ['Zeroth'], 'Year': [2000], 'DOI': ['10.1/w']}), file_path)
+    for chunk in CHUNKS:
+        append_table(chunk, file_path)
+    compact_table(file_path)
+
+    assert not os.path.exists(_parts_dir(file_path))
+    df = read_table(file_path)
+    assert df['Title'].tolist() == ['Zeroth', 'First', 'Second', 'Third', 'Fourth', 'Fifth']
+    assert df['DOI'].tolist()[:4] == ['10.1/w', None, None, '10.1/x']
+    assert df['Year'].dropna().astype(int).tolist() == [2000, 2001, 2002, 2003, 2005]
+    assert df['Cited by'].dropna().tolist() == [3, 4]
+
+
+# A crash while a part was being written leaves only its .tmp, which must not block later runs
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_parts_left_by_a_crash_are_dropped(tmp_path, extension):
+    file_path = str(tmp_path / f'all_data{extension}')
+    os.makedirs(_parts_dir(file_path))
+    open(os.path.join(_parts_dir(file_path), f'000000{extension}.tmp'), 'wb').close()
+    compact_table(file_path)
+    assert not os.path.exists(_parts_dir(file_path))
+    assert read_table(file_path).empty
+
+    append_table(CHUNKS[0], file_path)
+    open(os.path.join(_parts_dir(file_path), f'000001{extension}.tmp'), 'wb').close()
+    compact_table(file_path)
+    assert read_table(file_path)['Title'].tolist() == ['First', 'Second']